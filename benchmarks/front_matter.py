@@ -0,0 +1,40 @@
+"""Times parsing notes for the index, for a small and a 1 MB note.
+
+    PYTHONPATH=. python benchmarks/front_matter.py
+
+Besides parse_file, the front matter alone is parsed by load_front_matter,
+which skips yaml for simple headers, and by the yaml loaders.
+"""
+import timeit
+
+import yaml
+
+from markdown_note.core import load_front_matter, parse_file
+
+header = 'title: A note about benchmarks\ngroup: perf\ndoi: 10.1000/xyz123\n'
+paragraph = ('Some text about @benchmarks and @python, with a [link](a.png) '
+             'and more words to fill the line.\n\n')
+
+
+def note(size):
+    body = paragraph * max(1, size // len(paragraph))
+    return f'---\n{header}---\n{body}'
+
+
+def main():
+    loaders = {'python yaml': yaml.SafeLoader,
+               'c yaml': getattr(yaml, 'CSafeLoader', None)}
+    small, large = note(1000), note(1000000)
+    print(f'{"case":<34}{"us":>12}')
+    for name, func in [
+            ('load_front_matter', lambda: load_front_matter(header)),
+            *[(f'{name} front matter', lambda l=loader: yaml.load(header, l))
+              for name, loader in loaders.items() if loader is not None],
+            ('parse_file 1 KB', lambda: parse_file(small)),
+            ('parse_file 1 MB', lambda: parse_file(large))]:
+        runs, seconds = timeit.Timer(func).autorange()
+        print(f'{name:<34}{seconds / runs * 1e6:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""Times rendering notes to html, with a renderer that is reused, like in
+mdn edit and mdn serve, and with one that is built for every note.
+
+    PYTHONPATH=. python benchmarks/render.py
+
+For short notes the fixed cost per render dominates, which reusing the
+renderer removes. Longer notes are dominated by the markdown conversion.
+"""
+import timeit
+
+from markdown_note.core import Renderer
+
+
+def note(sections):
+    return '---\ntitle: A note\ngroup: perf\n---\n' + '\n\n'.join(
+        f'## Section {i}\n\nSome *text* with a [link](a{i}.png) and `code`.'
+        for i in range(sections))
+
+
+def main():
+    reused = Renderer()
+    print(f'{"sections":<10}{"fresh us":>10}{"reused us":>11}')
+    for sections in [1, 10, 100]:
+        md = note(sections)
+        fresh_runs, fresh = timeit.Timer(
+            lambda: Renderer().render(md)).autorange()
+        reused_runs, reused_seconds = timeit.Timer(
+            lambda: reused.render(md)).autorange()
+        print(f'{sections:<10}{fresh / fresh_runs * 1e6:>10.1f}'
+              f'{reused_seconds / reused_runs * 1e6:>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
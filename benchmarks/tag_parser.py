@@ -0,0 +1,40 @@
+"""Times the tag expression parser on generated queries of growing size.
+
+    PYTHONPATH=. python benchmarks/tag_parser.py
+
+The time per tag should stay roughly constant for all shapes, i.e. parsing
+is linear in the length of the query.
+"""
+import timeit
+
+from markdown_note.tag_string_parser import create_predicate_from_tag_str
+
+# the uncached parser, otherwise only the first run would parse
+parse = create_predicate_from_tag_str.__wrapped__
+
+
+def flat(n):
+    return ' & '.join(f'@tag{i}' for i in range(n))
+
+
+def mixed(n):
+    return ' | '.join(f'@tag{i} & -@other{i}' for i in range(n // 2))
+
+
+def nested(n):
+    return '(' * n + ' | '.join(f'@tag{i}' for i in range(n)) + ')' * n
+
+
+def main():
+    print(f'{"shape":<8}{"tags":>8}{"ms":>10}{"us/tag":>10}')
+    for shape in [flat, mixed, nested]:
+        for n in [100, 1000, 10000, 100000]:
+            query = shape(n)
+            runs = max(1, 10000 // n)
+            seconds = timeit.timeit(lambda: parse(query), number=runs) / runs
+            print(f'{shape.__name__:<8}{n:>8}{seconds * 1e3:>10.2f}'
+                  f'{seconds * 1e6 / n:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,60 @@
+import hashlib
+import heapq
+import itertools
 import os
 import shutil
-import pickle
 import re
+import sqlite3
 import subprocess as sp
 import sys
+import threading
 import time
 from datetime import datetime
-from functools import lru_cache, reduce
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from html import escape
 from importlib import resources
 from pathlib import Path
-from typing import Any, Callable, Dict, List, NamedTuple, Set, Tuple, Union
+from typing import (Any, Callable, ContextManager, Dict, Iterator, List,
+                    NamedTuple, Optional, Set, Tuple)
 
-import bibtexparser
-import markdown
 import toolz as t
 import yaml
-from habanero import cn
-from tabulate import tabulate
-from yattag import Doc
 
+from . import index_store as idx
 from . import resources as res
 from .tag_string_parser import ParserError, create_predicate_from_tag_str
 from .attrdict import AttrDict
+from .index_store import Index
 
 PathFunc =  Callable[[], Path]
-Index = Dict[str, Set[int]]
 
 config_path = Path.home() / '.mdnrc'
 tag_pattern = re.compile(r'\B(@\w+)')
-link_pattern = re.compile(r"!?\[.*\]\((.*)\)")
+# the brackets and parens cant contain other brackets or parens, so a scan
+# never backtracks past the next one
+link_pattern = re.compile(r"!?\[[^\[\]]*\]\(([^()\s]*)\)")
 md_file_pattern = re.compile(r"\d+\.md")
+group_line_pattern = re.compile(r"group\s*:")
+# the yaml front matter, between the first line and the next line that are
+# both exactly ---
+front_matter_pattern = re.compile(r'---\r?\n(.*?)^---(?:\r?\n|\Z)',
+                                  re.DOTALL | re.MULTILINE)
+# a front matter line with a plain yaml scalar as value, that is parsed
+# without yaml if the value resolves to a string
+simple_header_line_pattern = re.compile(
+    r"""([A-Za-z_]\w*)[ \t]*:(?:[ \t]+([^\s\-?:,\[\]{}#&*!|>'"%@`]"""
+    r"""(?:(?!:\s)[^#])*?))?(?<!:)[ \t]*""")
+# the fulltext index consists of trigrams, so it can only find longer parts
+min_fulltext_part = 3
+min_files_for_process_pool = 100
+# the folder within the asset folder for content addressed assets
+blob_dir_name = '.blobs'
+# set by long running processes, to answer queries from memory
+keep_index_in_memory = False
+markdown_extensions = ['extra', 'toc']
+# increase whenever make_html changes, to invalidate all rendered notes
+renderer_version = 1
 
 
 special_id_mappings = {
@@ -72,25 +97,8 @@ def try_cast(target_type: type, val: Any) -> Any:
         return None
 
 
-def unlink_if_existing(pf: PathFunc):
-    p = pf()
-    if p.exists():
-        p.unlink()
-
-
-def find_id_in_single_index(ind: Index, id: int) -> str:
-    try:
-        return t.first(key for key, value in ind.items() 
-                       if id in value)
-    except StopIteration:
-        return None
-
-
-def find_id_in_multi_index(ind: Index, id: int) -> Set[str]:
-    return {key for key, val in ind.items() if id in val}
-
-
 def get_title_author_and_link(bibtex: str):
+    import bibtexparser
     info = bibtexparser.loads(bibtex).entries[0]
     title = info["title"]
     author_short = short_description(info["author"])
@@ -118,37 +126,84 @@ def short_description(authors):
 
 
 
+def load_bibtex_entries(dois: List[str], reload_cache: bool = False,
+                        transport: Optional[Callable[[str], str]] = None) \
+        -> Dict[str, str]:
+    '''Returns the bibtex entries of dois. Those that arent cached, or are
+    older than doi_cache_days of the config, or all if reload_cache is set,
+    are fetched concurrently, and stored in the cache in one transaction.
+    By default they are fetched from the doi_resolver of the config, or
+    doi.org'''
+    from . import crossref
+    conn = index_db()
+    migrate_doi_cache(conn)
+    config = load_config()
+    max_age_days = config.get('doi_cache_days')
+    entries = {} if reload_cache else idx.get_doi_entries(
+        conn, set(dois),
+        max_age_days and time.time() - float(max_age_days) * 24 * 3600)
+    missing = [doi for doi in dict.fromkeys(dois) if doi not in entries]
+    if missing:
+        transport = transport or crossref.http_transport(
+            config.get('doi_resolver', crossref.default_resolver))
+        fetched, failed = crossref.fetch_all(missing, transport)
+        idx.store_doi_entries(conn, fetched, time.time())
+        entries.update(fetched)
+        if failed:
+            error("There was a problem contacting crossref:\n" + "\n".join(
+                f"{doi}: {e}" for doi, e in failed.items()))
+    return {doi: entries[doi] for doi in dois}
+
+
 def load_bibtex_cached(doi, reload_cache=False):
-    cache = load_doi_cache()
-    if reload_cache or doi not in cache:
-        try:
-            entry = cn.content_negotiation(ids=doi)
-        except Exception as e:
-            error("There was a problem contacting crossref:\n", str(e))
+    return load_bibtex_entries([doi], reload_cache)[doi]
+
+
+bib_key_pattern = re.compile(r'(@\w+\s*\{\s*)([^,\s]+)')
+bib_doi_pattern = re.compile(r'\bdoi\s*=\s*[{"]\s*([^}"]*?)\s*[}"]',
+                             re.IGNORECASE)
 
-        cache[doi] = entry
-        store_doi_cache(cache)
-    return cache[doi]
 
+def normalize_doi(doi: str) -> str:
+    return re.sub(r'^(https?://(dx\.)?doi\.org/|doi:)', '', doi.strip(),
+                  flags=re.IGNORECASE).lower()
 
-def add_to_bib(entry, bib):
-    key = get_cite_key(entry)
-    if key in bib:
-        orig_key = key
-        num = 2
-        key = key + "_2"
-        while key in bib:
-            num += 1
-            key = orig_key + "_" + str(num)
-        entry = entry.replace(orig_key, key)
 
-    return bib + "\n\n" + entry
+def bib_keys_and_dois(bib: str) -> Tuple[Set[str], Set[str]]:
+    '''Returns the cite keys and the (normalized) dois of the entries of bib'''
+    return ({m.group(2) for m in bib_key_pattern.finditer(bib)},
+            {normalize_doi(m.group(1)) for m in bib_doi_pattern.finditer(bib)})
+
+
+def merge_bib_entries(entries: Dict[str, str], bib: str) \
+        -> Tuple[List[str], List[str]]:
+    '''Returns the entries (by doi) that arent in bib yet, and the dois of
+    those that are. A cite key that is already taken gets the suffix _2, _3,
+    ... '''
+    keys, dois = bib_keys_and_dois(bib)
+    new, skipped = [], []
+    for doi, entry in entries.items():
+        match = bib_doi_pattern.search(entry)
+        entry_doi = normalize_doi(match.group(1) if match else doi)
+        if entry_doi in dois:
+            skipped.append(doi)
+            continue
+        key = get_cite_key(entry)
+        unique_key, num = key, 2
+        while unique_key in keys:
+            unique_key, num = f'{key}_{num}', num + 1
+        if unique_key != key:
+            entry = bib_key_pattern.sub(lambda m: m.group(1) + unique_key,
+                                        entry, count=1)
+        keys.add(unique_key)
+        dois.add(entry_doi)
+        new.append(entry)
+    return new, skipped
 
 
 def get_cite_key(entry):
-    start = entry.find("{")
-    end = entry.find(",")
-    return entry[start + 1: end]
+    match = bib_key_pattern.search(entry)
+    return match.group(2) if match else ''
 
 
 def get_bib_path(path):
@@ -163,22 +218,20 @@ def get_bib_path(path):
 
 
 
-def multipattern_to_ids(pattern, group, tags, config=None, state=None,
-        group_index=None, title_index=None, tags_index=None):
+def multipattern_to_ids(pattern, group, tags, config=None, state=None):
     if len(pattern) == 0:
         pattern = [""]
     if len(pattern) == 1:
         if pattern[0].isnumeric():
             ids = pattern
         else:
-            rows = filter_files(pattern[0], group, tags, group_index,
-                    title_index, tags_index)
+            rows = filter_files(pattern[0], group, tags)
             ids = [row.id for row in rows]
     else:
         ids = []
         config = config or load_config()
         state = state or load_state()
-        title_index = title_index or load_title_index()
+        title_index = load_title_index()
         for pat in pattern:
             path, int_id = parse_id(pat, Path(config.save_path), 
                                     state, title_index)
@@ -210,67 +263,306 @@ def get_hits(pattern: re.Pattern, body: str, context_len: int = 15):
     return res
 
 
-def cat_one(id: str, no_header: bool):
-    """Prints the notes source to stdout. Use -n to hide the yaml header"""
-    state = load_state()
-    # config = load_config()
-    path, int_id = parse_id(id, Path(load_config().save_path), state, 
-                            load_title_index())
-    content = path.read_text().splitlines()
-    h_end = 1 + content[1:].index('---')
-    content = ("\n".join(content[h_end + 1:] if no_header else
-        content).strip())
+def fulltext_query(elems: List[str]) -> Optional[str]:
+    '''Translates the parts of a wildcard pattern into an fts5 query, that
+    selects the notes which contain every part. Parts shorter than
+    min_fulltext_part cant be looked up in the trigram index and are left
+    out, so the query selects a superset of the notes that match the
+    pattern. Returns None if no part is long enough.'''
+    phrases = ['"' + elem.replace('"', '""') + '"' for elem in elems
+               if len(elem) >= min_fulltext_part]
+    return ' AND '.join(phrases) or None
+
+
+def search_notes(pattern: re.Pattern, query: Optional[str]) \
+        -> Iterator[Tuple[int, List[str]]]:
+    '''Yields the id and the hits of every note that matches pattern. If a
+    fulltext query is given, only the notes it selects are scanned, best
+    ranked first, followed by the notes whose fulltext index entry is
+    missing or outdated, e.g. because they were changed outside of mdn.
+    Otherwise all notes are scanned.'''
+    conn = index_db()
+    md_dir = Path(load_config().save_path, 'md')
+    if query is None or not idx.has_fulltext(conn):
+        ids = [int(file.stem) for file in md_dir.iterdir()]
+    else:
+        ids = list(dict.fromkeys(idx.search_fulltext(conn, query)
+                                 + stale_ids(conn, md_dir)))
+    for id in ids:
+        try:
+            hits = get_hits(pattern, (md_dir / f'{id}.md').read_text())
+        except FileNotFoundError:
+            continue
+        if hits:
+            yield id, hits
+
+
+def stale_ids(conn: sqlite3.Connection, md_dir: Path) -> List[int]:
+    '''Ids of the notes whose file isnt in the index as it is now. Only
+    stats the files'''
+    indexed = idx.file_stats(conn)
+    ids = []
+    with os.scandir(md_dir) as entries:
+        for entry in entries:
+            if md_file_pattern.fullmatch(entry.name) is None:
+                continue
+            id, st = int(entry.name[:-3]), entry.stat()
+            if indexed.get(id) != (st.st_mtime, st.st_size):
+                ids.append(id)
+    return ids
+
+
+def cat_one(id: str, no_header: bool, asset_dir: Path = None):
+    """Prints the notes source to stdout. Use -n to hide the yaml header.
+    Pass asset_dir when printing many notes, so it is only computed once"""
+    config = load_config()
+    if str(id).isnumeric():
+        path = md_path(id, config)
+    else:
+        path, _ = parse_id(id, Path(config.save_path), load_state(),
+                           load_title_index())
+    content = path.read_text()
+    if no_header:
+        content = (split_front_matter(content) or ('', content))[1]
     print()
-    print(adjust_links(content))
+    print(adjust_links(content.strip(), asset_dir), flush=True)
 
 
-def id_to_row(id, config, group_index, title_index):
+def id_to_row(id, config, notes):
     file = Path(config.save_path) / "md" / f"{id}.md"
-    title_lookup = {id: title 
-                    for title, ids in title_index.items() for id in ids}
-    group_lookup = {id: group 
-                    for group, ids in group_index.items() for id in ids}
-    return Row(file.stem, title_lookup[id], group_lookup[id],
+    note = notes[id]
+    return Row(file.stem, note.title, note.group,
             datetime.fromtimestamp(file.stat().st_mtime)
             .replace(microsecond=0))
 
 
-def adjust_links(s: str):
-    matches = list(link_pattern.finditer(s))
-    if len(matches) == 0:
+def adjust_links(s: str, asset_dir: Path = None) -> str:
+    '''Replaces the targets of all links in s by their path in the asset
+    folder'''
+    targets = set(link_targets(s))
+    if not targets:
         return s
+    asset_dir = asset_dir or Path(load_config().save_path, 'assets')
+    assets = resolve_assets(list(targets))
+    return rewrite_link_targets(s, {
+        target: str(asset_dir / assets.get(target, target))
+        for target in targets})
+
+
+def link_targets(md: str) -> List[str]:
+    return [m.group(1) for m in link_pattern.finditer(md)]
+
+
+def rewrite_link_targets(md: str, assets: Dict[str, str]) -> str:
+    '''Replaces the targets of all links, that are keys of assets'''
+    def replace(m):
+        target = m.group(1)
+        if target not in assets:
+            return m.group(0)
+        start, end = m.start(1) - m.start(0), m.end(1) - m.start(0)
+        return m.group(0)[:start] + assets[target] + m.group(0)[end:]
+    return link_pattern.sub(replace, md)
+
+
+def make_html(md: str, assets: Dict[str, str] = None) -> str:
+    '''assets maps the names of content addressed assets, that md links
+    to, to their blobs, see resolve_assets'''
+    return renderer().render(md, assets)
+
+
+class Renderer:
+    '''Converts notes to html pages. The markdown converter and the parts
+    of the page around the note are built once, so that every render only
+    converts the markdown of the note'''
+    def __init__(self):
+        import markdown
+        self.markdown = markdown.Markdown(extensions=markdown_extensions)
+        self.lock = threading.Lock()
+        self.prefix = '<!DOCTYPE html><html><head><title>'
+        self.infix = ('</title><meta charset="utf-8">'
+                      '<base href="../assets/">'
+                      f'<style>{content_css()}</style></head>'
+                      '<body class="body">')
+        self.suffix = '</body></html>'
+
+    def render(self, md: str, assets: Dict[str, str] = None) -> str:
+        if assets:
+            md = rewrite_link_targets(md, assets)
+        header, body = split_front_matter(md) or ('', md)
+        title = load_front_matter(header).get('title') or 'No Title'
+        with self.lock:
+            html = self.markdown.reset().convert(body)
+        return ''.join([self.prefix, escape(str(title), quote=False),
+                        self.infix, html, self.suffix])
+
+
+@lru_cache(1)
+def renderer() -> Renderer:
+    return Renderer()
+
 
-    abs_save_paths = [Path(load_config().save_path, 'assets', m.group(1)) 
-                      for m in matches]
-
-    first_segment = s[:matches[0].start(1)]
-    segments = [s[m1.end(1):m2.start(1)] 
-            for m1, m2 in t.sliding_window(2, matches)]
-    last_segment = s[matches[-1].end(1):]
-    return "".join(t.interleave([[first_segment] + segments, 
-                                  map(str, abs_save_paths)])) + last_segment
-        
-    
-
-
-def make_html(md: str) -> str:
-    lines = md.splitlines()
-    content_start_line = lines[1:].index('---') + 2
-    title = yaml.safe_load('\n'.join(lines[1:content_start_line - 1]))\
-                .get('title')
-    md_code = markdown.markdown('\n'.join(lines[content_start_line:]), 
-                                extensions=['extra', 'toc'])
-    doc, tag, text, line = Doc().ttl()
-    doc.asis('<!DOCTYPE html>')
-    with tag('html'):
-        with tag('head'):
-            line('title', title or 'No Title')
-            doc.asis('<meta charset="utf-8">')
-            doc.asis('<base href="../assets/">')
-            line('style', resources.read_text(res, 'content.css'))
-        with tag('body', klass="body"):
-            doc.asis(md_code)
-    return doc.getvalue()
+@lru_cache(1)
+def content_css() -> str:
+    return resources.read_text(res, 'content.css')
+
+
+@lru_cache(1)
+def renderer_fingerprint() -> bytes:
+    '''Everything besides the note itself that influences make_html'''
+    import markdown
+    return repr((renderer_version, markdown.__version__, markdown_extensions,
+                 content_css())).encode()
+
+
+def render_key(md: str, assets: Dict[str, str] = None) -> str:
+    key = hashlib.sha256(renderer_fingerprint() + md.encode())
+    if assets:
+        key.update(repr(sorted(assets.items())).encode())
+    return key.hexdigest()
+
+
+def write_atomically(path: Path, text: str):
+    '''Writes text to a temporary file next to path, and then replaces
+    path with it, so that readers never see a partially written file'''
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        tmp.write_text(text)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def render_file(md_file: Path, html_file: Path,
+                assets: Dict[str, str] = None) -> str:
+    '''Renders md_file to html_file and returns the render key'''
+    md = md_file.read_text()
+    html_file.parent.mkdir(0o755, True, True)
+    write_atomically(html_file, make_html(md, assets))
+    return render_key(md, assets)
+
+
+def is_html_fresh(id: int, md: str, config: AttrDict) -> bool:
+    return (html_path(id, config).exists()
+            and idx.get_render_keys(index_db(), [id]).get(id)
+                == render_key(md, note_assets(md)))
+
+
+def write_html(id: int, md: str, config: AttrDict):
+    '''Renders md as the html of note id, and records its render key'''
+    htmlpath = html_path(id, config)
+    htmlpath.parent.mkdir(0o755, True, True)
+    assets = note_assets(md)
+    write_atomically(htmlpath, make_html(md, assets))
+    idx.set_render_keys(index_db(), {id: render_key(md, assets)})
+
+
+def render_cached(id: int, config: AttrDict) -> Path:
+    '''Returns the path of the html version of a note, which is rendered
+    first if the note, the stylesheet or the renderer changed since it was
+    rendered the last time'''
+    id = int(id)
+    md = md_path(id, config).read_text()
+    if not is_html_fresh(id, md, config):
+        write_html(id, md, config)
+    return html_path(id, config)
+
+
+def forget_html(ids: List[int], config: AttrDict):
+    ids = list(map(int, ids))
+    for id in ids:
+        htmlpath = html_path(id, config)
+        if htmlpath.exists():
+            htmlpath.unlink()
+    idx.remove_render_keys(index_db(), ids)
+
+
+def render_notes(ids: List[int], config: AttrDict, jobs: int = None,
+                 force: bool = False) -> int:
+    '''Renders all notes in ids, whose html is outdated, or all of them if
+    force is set. Returns the number of rendered notes'''
+    ids = list(map(int, ids))
+    keys = idx.get_render_keys(index_db(), ids)
+    stale, stale_assets = [], []
+    for id in ids:
+        md = md_path(id, config).read_text()
+        assets = note_assets(md)
+        if (force or not html_path(id, config).exists()
+                or keys.get(id) != render_key(md, assets)):
+            stale.append(id)
+            stale_assets.append(assets)
+    new_keys = pool_map(render_file, [md_path(id, config) for id in stale],
+                        [html_path(id, config) for id in stale],
+                        stale_assets, jobs=jobs)
+    idx.set_render_keys(index_db(), dict(zip(stale, new_keys)))
+    return len(stale)
+
+
+def uses_content_addressed_assets(config: AttrDict) -> bool:
+    return bool(config.get('content_addressed_assets', False))
+
+
+def resolve_assets(names: List[str]) -> Dict[str, str]:
+    '''Maps those of names that are content addressed assets to the path
+    of their content, relative to the asset folder'''
+    if not names:
+        return {}
+    return idx.get_asset_blobs(index_db(), names)
+
+
+def note_assets(md: str) -> Dict[str, str]:
+    return resolve_assets(link_targets(md))
+
+
+def copy_hashed(src: Path, dst: Path) -> str:
+    '''Copies src to dst block by block and returns the sha256 of the
+    content, so large files are only read once'''
+    digest = hashlib.sha256()
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            digest.update(block)
+            fout.write(block)
+    return digest.hexdigest()
+
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def asset_exists(name: str, config: AttrDict) -> bool:
+    return (Path(config.save_path, 'assets', name).exists()
+            or bool(resolve_assets([name])))
+
+
+def add_asset(src: Path, name: str, config: AttrDict):
+    '''Copies src into the asset folder, as name. If content addressed
+    assets are used, the content is stored in a blob named by its hash,
+    once for all names with the same content, and name is recorded in the
+    manifest'''
+    asset_dir = Path(config.save_path, 'assets')
+    if not uses_content_addressed_assets(config):
+        dst = asset_dir / name
+        dst.parent.mkdir(0o755, True, True)
+        shutil.copyfile(src, dst)
+        return
+    blob_dir = asset_dir / blob_dir_name
+    blob_dir.mkdir(0o755, True, True)
+    tmp = blob_dir / f'.{os.getpid()}.tmp'
+    try:
+        hash = copy_hashed(src, tmp)
+        conn = index_db()
+        blob = idx.blob_for_hash(conn, hash)
+        if blob is None or not (asset_dir / blob).exists():
+            blob = f'{blob_dir_name}/{hash}{Path(name).suffix.lower()}'
+            os.replace(tmp, asset_dir / blob)
+        idx.set_asset(conn, name, hash, blob)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
 
 
 class Row(NamedTuple):
@@ -286,53 +578,104 @@ def assert_all_files_valid(files: List[Path]):
             error(f"Found an invalid file in the md folder: {f.name}")
 
 
-def filter_files(pattern:str, group: str, tags: str, 
-                 group_index: Index = None,
-                 title_index: Index = None,
-                 tags_index: Index = None) -> List[Row]:
-    files = list(Path(load_config().save_path, 'md').iterdir())
-    assert_all_files_valid(files)
-    title_index = title_index or load_title_index()
-    title_lookup = {str(id): title 
-                    for title, ids in title_index.items() for id in ids}
-    group_index = group_index or load_group_index()
-    group_lookup = {str(id): group 
-                    for group, ids in group_index.items() for id in ids}
-    tags_index = tags_index or load_tag_index()
-    tags_lookup = {id: find_id_in_multi_index(tags_index, int(id)) 
-                   for id in (file.stem for file in files)}
-    rows = [Row(file.stem, title_lookup[file.stem], group_lookup[file.stem],
-             datetime.fromtimestamp(file.stat().st_mtime)
-                     .replace(microsecond=0))
-            for file in files]
-    if group:
-        rows = [row for row in rows if group.lower() in row[2].lower()]
-    if tags:
+def _unindexed_rows(conn: sqlite3.Connection) -> List[Row]:
+    '''Rows for the notes whose mtime isnt in the index, from their files'''
+    rows = []
+    for id in idx.unindexed_ids(conn):
+        note = idx.get_note(conn, id)
+        if note is None:
+            # removed by another process meanwhile
+            continue
         try:
-            predicate = create_predicate_from_tag_str(tags.lower())
-        except ParserError as e:
-            error(f"Couldnt parse the tag string. Problematic bit: {e.reason}"
-                    "\nMaybe you missed an @?")
-        rows = [row for row in rows if predicate(tags_lookup[row[0]])]
-    if pattern:
-        pattern = re.compile(".*".join(pattern), re.I)
-        rows = [row for row in rows if pattern.search(row[1])]
+            mtime = md_path(id, load_config()).stat().st_mtime
+        except FileNotFoundError:
+            continue
+        rows.append(Row(str(id), note.title, note.group,
+                        datetime.fromtimestamp(mtime).replace(microsecond=0)))
+    rows.sort(key=lambda row: row.ts, reverse=True)
     return rows
 
 
+def _indexed_rows(conn: sqlite3.Connection) -> Iterator[Row]:
+    '''Lazily yields the rows of the notes whose mtime is in the index, the
+    most recently edited first'''
+    for id, title, grp, mtime in idx.iter_by_mtime(conn):
+        if mtime is None:
+            return
+        yield Row(str(id), title, grp,
+                  datetime.fromtimestamp(mtime).replace(microsecond=0))
+
+
+def _rows_by_mtime(conn: sqlite3.Connection) -> Iterator[Row]:
+    '''Lazily yields the rows of all notes, the most recently edited first'''
+    return heapq.merge(_indexed_rows(conn), _unindexed_rows(conn),
+                       key=lambda row: row.ts, reverse=True)
+
+
+def query_notes(pattern: str, group: str, tags: str, offset: int = 0,
+                limit: int = None) -> Iterator[Row]:
+    '''Lazily yields the rows of the matching notes, the most recently
+    edited first. Only the notes up to offset + limit are looked at, so the
+    first rows are there quickly, no matter how many notes exist.
+    If keep_index_in_memory is set, the rows come from load_listing.
+    Raises ParserError if tags cant be parsed'''
+    conn = index_db()
+    if keep_index_in_memory:
+        listing = load_listing()
+        rows: Iterator[Row] = iter(listing.rows)
+        get_postings = lambda tags: listing.tags
+        get_ids = lambda: listing.ids
+    else:
+        rows = _rows_by_mtime(conn)
+        get_postings = lambda tags: idx.load_tag_postings(conn, tags)
+        get_ids = lambda: idx.note_ids(conn)
+
+    selected = None
+    if tags:
+        predicate = create_predicate_from_tag_str(tags.lower())
+        selected = predicate.select(get_postings(predicate.tag_names()),
+                                    get_ids())
+    title_pattern = pattern and re.compile(".*".join(pattern), re.I)
+    group = group and group.lower()
+
+    rows = (row for row in rows
+            if (not group or group in row.group.lower())
+            and (selected is None or int(row.id) in selected)
+            and (not title_pattern or title_pattern.search(row.title)))
+    return itertools.islice(rows, offset,
+                            None if limit is None else offset + limit)
+
+
+def filter_files(pattern: str, group: str, tags: str, offset: int = 0,
+                 limit: int = None) -> List[Row]:
+    '''Like query_notes, but exits with an error message if tags cant be
+    parsed'''
+    try:
+        return list(query_notes(pattern, group, tags, offset, limit))
+    except ParserError as e:
+        error(f"Couldnt parse the tag string at position {e.position}. "
+              f"Problematic bit: {e.reason}\nMaybe you missed an @?")
+        assert False # mypy
+
+
 def print_table(rows):
+    from tabulate import tabulate
     print(tabulate(list(sorted(rows, key=lambda x: x[3], reverse=True)),
                    'id title group last_edit'.split()))
 
 
-def get_user_delete_confirmation(rows):
-    print("Do you really wanna delete the following files?\n")
+def get_user_confirmation(question, rows):
+    print(f"Do you really wanna {question} the following files?\n")
     print_table(rows)
     print()
-    return query_value("Delete? y/n: ", None, t.identity, 
+    return query_value(f"{question.capitalize()}? y/n: ", None, t.identity, 
                        lambda x: x in "yn", "") == 'y'
 
 
+def get_user_delete_confirmation(rows):
+    return get_user_confirmation("delete", rows)
+
+
 def md_path(id, config):
     return Path(config.save_path, 'md', f'{id}.md')
 
@@ -341,118 +684,201 @@ def html_path(id, config):
     return Path(config.save_path, 'html', f'{id}.html')
 
 
-def delete_md(id: str, config: AttrDict):
-    file = md_path(id, config)
-    if not file.exists():
-        error("""The File thats supposed to be deleted does not seem to exist.
-                 Please run 'mdn regenerate' and try again""")
-    file.unlink()
+def update_index_files_as_necessary(title: str, tags: Set[str], 
+        group: str, doi: Optional[str], id: int,
+        content: Optional[str] = None):
+    st = md_path(id, load_config()).stat()
+    idx.upsert_note(index_db(), idx.NoteRecord(
+        id, title, group, doi, tags, st.st_mtime, st.st_size, content))
+
+
+def index_batch() -> ContextManager[idx.Batch]:
+    '''Starts a batch of index changes, that is commited at once, see
+    index_store.batch'''
+    return idx.batch(index_db())
+
+
+def rewrite_notes(ids: List[int], transform: Callable[[str], str],
+                  config: AttrDict) -> List[int]:
+    '''Replaces the content of every note in ids by the result of transform.
+    All notes are transformed and parsed first, and if one of them fails,
+    nothing is changed. Then the notes are written, and the index of those
+    that were written is updated in a single transaction. Returns the ids of
+    the notes that couldnt be written'''
+    contents = {}
+    for id in ids:
+        try:
+            content = transform(md_path(id, config).read_text())
+            parse_note(content)
+        except (OSError, NoteFormatError) as e:
+            error(f'''Couldnt change note {id}, so no note was changed:
+                {e}''')
+        contents[id] = content
+    written, failed = [], []
+    for id, content in contents.items():
+        try:
+            write_atomically(md_path(id, config), content)
+            written.append(id)
+        except OSError as e:
+            print(f"Couldnt write note {id}: {e}", file=sys.stderr)
+            failed.append(id)
+    with index_batch() as batch:
+        for id in written:
+            batch.upsert(index_record(md_path(id, config)))
+    return failed
+
+
+def set_group(content: str, group: str) -> str:
+    '''Returns content with the group in the front matter replaced. Raises
+    NoteFormatError if content has no front matter'''
+    parts = split_front_matter(content)
+    if parts is None:
+        raise NoteFormatError('The note doesnt start with a front matter')
+    header, body = parts
+    lines = header.splitlines()
+    group_line = yaml.safe_dump({'group': group}, allow_unicode=True).strip()
+    for i, line in enumerate(lines):
+        if group_line_pattern.match(line):
+            lines[i] = group_line
+            break
+    else:
+        lines.append(group_line)
+    return '---\n' + ''.join(line + '\n' for line in lines) + '---\n' + body
 
 
-def update_index_files_as_necessary(title: str, tags: Set[str], 
-        group: str, doi: str, id: int):
-    group_index = load_group_index()
-    title_index = load_title_index()
-    tag_index = load_tag_index()
-    doi_index = load_doi_index()
-    old_title = find_id_in_single_index(title_index, id)
-    old_group = find_id_in_single_index(group_index, id)
-    old_doi = find_id_in_single_index(doi_index, id)
-    old_tags = find_id_in_multi_index(tag_index, id)
-
-    if title != old_title:
-        store_title_index(update_single_index(title_index, title,
-                                              old_title, id))
-    if tags != old_tags:
-        store_tag_index(update_multi_index(tag_index, tags, 
-                                           old_tags, id))
-    if doi != old_doi:
-        store_doi_index(update_single_index(doi_index, doi, 
-                                            old_doi, id))
-    if group != old_group:
-        store_group_index(update_single_index(group_index, group, 
-                                              old_group, id))
+def rename_tag(content: str, old: str, new: str) -> str:
+    return re.sub(r'\B' + re.escape(old) + r'(?!\w)', new, content,
+                  flags=re.I)
 
 
 def edit_externally(path: Path, config: AttrDict, render_html:
-                Callable[[str], None]) -> None:
-    last_edited = path.stat().st_mtime
-    try:
-        edit_proc = sp.Popen(config.editor_cmd.format(path), shell=True)
-    except sp.CalledProcessError as err:
-        error(f' There was a problem with the editor command: {err}')
-        assert False # mypy
-    
-    while edit_proc.poll() is None:
-        time.sleep(1)
-        new_last_edited = path.stat().st_mtime 
-        if new_last_edited > last_edited:
-            render_html(path.read_text())
-            last_edited = new_last_edited
-
-
-def remove_index_entry(index: Index , entry: str, id: Union[int, str]) -> Index:
-    if entry is None:
-        return index
-    try:
-        if len(index[entry]) == 1:
-            return t.dissoc(index, entry)
-        else:
-            return t.update_in(index, [entry], lambda x: x - {id})
-    except KeyError:
-        error('''
-            It seems the Index is corrupt. Please run 
-            `mdn regenerate` and try again''')
-        assert False # just for mypy <3 
+                Callable[[str], None]) -> List[float]:
+    '''Opens path in the editor and calls render_html after every save.
+    Returns the time between noticing each save and the end of the
+    corresponding render_html call in seconds'''
+    from . import watch
+    latencies = []
+    with watch.watch(path.parent, {path.name}) as watcher:
+        try:
+            edit_proc = sp.Popen(config.editor_cmd.format(path), shell=True)
+        except sp.CalledProcessError as err:
+            error(f' There was a problem with the editor command: {err}')
+            assert False # mypy
+
+        while edit_proc.poll() is None:
+            changes = watcher.wait(timeout=0.5)
+            if changes.names and path.exists():
+                render_html(path.read_text())
+                latencies.append(time.monotonic() - changes.first_seen)
+    return latencies
+
+
+def split_front_matter(content: str) -> Optional[Tuple[str, str]]:
+    '''Returns the yaml front matter and the body of a note, or None if it
+    doesnt start with a front matter'''
+    match = front_matter_pattern.match(content)
+    if match is None:
+        return None
+    return match.group(1), content[match.end():]
 
 
-def insert_index_entry(index: Index, entry: str, id: int) -> int:
-    if entry in index:
-        return t.update_in(index, [entry], lambda x: x | {id})
-    else:
-        return t.assoc(index, entry, {id})
+def load_front_matter(header: str) -> AttrDict:
+    '''Parses the yaml front matter. If it only consists of key: value lines
+    with string values, like the headers mdn creates, yaml isnt needed'''
+    front_matter = {}
+    for line in header.splitlines():
+        match = simple_header_line_pattern.fullmatch(line)
+        value = match and match.group(2)
+        if match is None or (value is not None and yaml_scalar_tag(value)
+                             != yaml.resolver.BaseResolver.DEFAULT_SCALAR_TAG):
+            loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+            return AttrDict(yaml.load(header, Loader=loader) or {})
+        front_matter[match.group(1)] = value
+    return AttrDict(front_matter)
+
+
+def yaml_scalar_tag(value: str) -> str:
+    '''The tag yaml assigns to value as a plain scalar, e.g. the one of int
+    for 12'''
+    return yaml_resolver().resolve(yaml.ScalarNode, value, (True, False))
 
 
-def update_single_index(index: Index, new: str, old: str, id: int) -> Index:
-    return t.thread_first(index, 
-        (remove_index_entry, old, id), 
-        (insert_index_entry, new, id))
+@lru_cache(1)
+def yaml_resolver() -> yaml.resolver.Resolver:
+    return yaml.resolver.Resolver()
 
 
-def update_multi_index(index: Index, new: Set[str], old: Set[str], id: int)\
-        -> Index:
-    '''Multi index means that the same id can be member of multiple entries'''
-    added_tags = new - old
-    removed_tags = old - new
-    index_with_new_tags = reduce(t.partial(insert_index_entry, id=id), 
-                                 added_tags, index)
-    return reduce(t.partial(remove_index_entry, id=id), 
-                  removed_tags, index_with_new_tags)
+class NoteFormatError(ValueError):
+    pass
 
 
-def parse_file(content: str) -> Tuple[str, Set[str], str]:
-    lines = content.splitlines()
-    if not lines[0] == '---' and lines[1:].count('---') == 1:
-        error('''
+def parse_note(content: str) -> Tuple[str, Set[str], str, Optional[str]]:
+    '''Returns the title, tags, group and doi of a note. Raises
+    NoteFormatError if it is malformed'''
+    parts = split_front_matter(content)
+    if parts is None:
+        raise NoteFormatError(strip_lines('''
             The md file must contain exactly 2 lines consisting of
             ---
-            The first of which must be the first line.
-            Please correct the file by calling `mdn edit _e`''')
-    front_matter = AttrDict(yaml.safe_load('\n'.join(
-        lines[1:lines[1:].index('---') + 1])))
-    assert_front_matter_correct(front_matter)
-    tags = t.thread_last(tag_pattern.findall(content),
-                       (map, str.lower),
-                       (set))
+            The first of which must be the first line.'''))
+    header, body = parts
+    try:
+        front_matter = load_front_matter(header)
+    except yaml.YAMLError as e:
+        raise NoteFormatError(f'The front matter isnt valid yaml: {e}')
+    if not ('title' in front_matter and 'group' in front_matter):
+        raise NoteFormatError('The front matter must contain a title field '
+                              'and a group field')
+    tags = {tag.lower() for tag in tag_pattern.findall(body)}
     return front_matter.title, tags, front_matter.group,\
             front_matter.get("doi", None)
 
 
-def assert_front_matter_correct(front_matter: str):
-    if not (hasattr(front_matter, 'title')
-            and hasattr(front_matter, 'group')):
-        error('''The front_matter must contain a title field
-              and a group field''')
+def parse_file(content: str) -> Tuple[str, Set[str], str, Optional[str]]:
+    '''Like parse_note, but exits with an error message if the note is
+    malformed'''
+    try:
+        return parse_note(content)
+    except NoteFormatError as e:
+        error(f'''{e}
+            Please correct the file by calling `mdn edit _e`''')
+        assert False # mypy
+
+
+def index_record(file: Path) -> idx.NoteRecord:
+    '''Parses a note file into the record that is stored in the index'''
+    st = file.stat()
+    content = file.read_text()
+    title, tags, group, doi = parse_file(content)
+    return idx.NoteRecord(int(file.stem), title, group, doi, tags,
+                          st.st_mtime, st.st_size, content)
+
+
+def pool_map(func: Callable, *iterables: List, jobs: int = None) -> Iterator:
+    '''Like map, but larger amounts of items are processed by a pool of jobs
+    processes. func must be picklable'''
+    jobs = jobs or os.cpu_count() or 1
+    n_items = len(iterables[0])
+    if jobs == 1 or n_items < min_files_for_process_pool:
+        yield from map(func, *iterables)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(jobs) as pool:
+        yield from pool.map(func, *iterables,
+                            chunksize=max(1, n_items // (jobs * 8)))
+
+
+def parse_files(files: List[Path], jobs: int = None) \
+        -> Iterator[idx.NoteRecord]:
+    '''Yields the index records for files, in the same order'''
+    return pool_map(index_record, files, jobs=jobs)
+
+
+def is_index_record_stale(file: Path, note: idx.NoteRecord) -> bool:
+    if note is None:
+        return True
+    st = file.stat()
+    return st.st_mtime != note.mtime or st.st_size != note.size
 
 
 def assert_path_exists(p: Path):
@@ -500,7 +926,7 @@ def load_config() -> AttrDict:
         return AttrDict(yaml.safe_load(config_path.read_text()))
     config = query_config()
     config_path.parent.mkdir(0o755, True, True)
-    config_path.write_text(yaml.dump(t.valmap(str, config)))
+    write_atomically(config_path, yaml.dump(t.valmap(str, config)))
     return config
 
 
@@ -564,21 +990,122 @@ def load(pf: PathFunc, default: Callable[[], Any] = AttrDict)\
 
 @t.curry
 def store(pf: PathFunc, index: Index) -> None:
-    pf().write_text(yaml.dump(dict(index)))
+    write_atomically(pf(), yaml.dump(dict(index)))
 
 
-def load_doi_cache():
-    p = doi_cache_path()
-    if not p.exists():
-        return {}
+@contextmanager
+def locked() -> Iterator[None]:
+    '''Holds an exclusive advisory lock on the save path, for read modify
+    write cycles of the state. Not reentrant. Without fcntl (i.e. on
+    windows) nothing is locked'''
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    path = lock_path()
+    path.parent.mkdir(0o755, True, True)
+    with path.open('a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
-    with p.open('rb') as f:
-        return pickle.load(f)
+
+def update_state(**changes):
+    '''Sets the fields of the state given by changes, without losing those
+    that other processes changed in the meantime'''
+    with locked():
+        save_state(t.merge(load_state(), changes))
+
+
+@lru_cache(1)
+def index_db() -> sqlite3.Connection:
+    '''Opens the index database. If it doesnt exist yet, but yaml indexes
+    from an older version of mdn do, they are imported once and then renamed
+    to *.yaml.bak'''
+    path = index_db_path()
+    is_new = not path.exists()
+    path.parent.mkdir(0o755, True, True)
+    try:
+        conn = idx.connect(path)
+    except idx.SchemaError as e:
+        error(f'{e}. Please update mdn or run `mdn regenerate`')
+    if is_new:
+        migrate_yaml_indexes(conn)
+    replay_journal(conn)
+    return conn
+
+
+def begin_edit(id: int):
+    '''Records in the journal, that this process is about to edit the note
+    id, until the index is updated with its new content'''
+    idx.journal_edit(index_db(), id, os.getpid())
 
 
-def store_doi_cache(cache):
-    with doi_cache_path().open('wb') as f:
-        return pickle.dump(cache, f)
+def is_process_running(pid: int) -> bool:
+    if os.name == 'nt':
+        # os.kill would terminate the process
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def replay_journal(conn: sqlite3.Connection):
+    '''Reindexes the notes in the journal whose editing process has ended
+    without updating the index'''
+    ids = [id for id, pid in idx.journaled_edits(conn).items()
+           if not is_process_running(pid)]
+    if len(ids) == 0:
+        return
+    config = load_config()
+    for id in ids:
+        path = md_path(id, config)
+        try:
+            if path.exists():
+                idx.upsert_note(conn, index_record(path))
+            else:
+                idx.remove_note(conn, id)
+        except SystemExit:
+            # the note is malformed, `mdn regenerate -i` reindexes it after
+            # it was fixed
+            idx.invalidate(conn, id)
+
+
+def migrate_yaml_indexes(conn: sqlite3.Connection):
+    yaml_paths = [pf() for pf in [title_idx_path, group_idx_path,
+                                  tag_idx_path, doi_idx_path]]
+    if not any(p.exists() for p in yaml_paths):
+        return
+
+    idx.import_indexes(conn, *(load(pf, dict) for pf in
+                               [title_idx_path, group_idx_path,
+                                tag_idx_path, doi_idx_path]))
+    for p in yaml_paths:
+        if p.exists():
+            p.rename(p.with_suffix('.yaml.bak'))
+    print('Imported the index files of an older mdn version. Run '
+          '`mdn regenerate -i` to add the notes to the search index.',
+          file=sys.stderr)
+
+
+def migrate_doi_cache(conn: sqlite3.Connection):
+    '''Imports the pickled doi cache of older versions once, and renames it
+    to doi_cache.pkl.bak'''
+    p = doi_cache_path()
+    if not p.exists():
+        return
+    import pickle
+    with p.open('rb') as f:
+        cache = pickle.load(f)
+    idx.store_doi_entries(conn, cache, p.stat().st_mtime)
+    p.rename(p.with_suffix('.pkl.bak'))
 
 
 def get_pdf_template(pdf: Path, pdf_res_path: Path):
@@ -588,31 +1115,91 @@ def get_pdf_template(pdf: Path, pdf_res_path: Path):
             abs_save_path =  asset_dir / pdf.name
         else:
             abs_save_path = asset_dir / pdf_res_path
-        if not abs_save_path.exists():
-            abs_save_path.parent.mkdir(exist_ok=True, parents=True)
-            shutil.copyfile(pdf.expanduser(), abs_save_path)
-        else:
+        name = str(abs_save_path.relative_to(asset_dir))
+        config = load_config()
+        if not asset_exists(name, config):
+            add_asset(pdf.expanduser(), name, config)
+        elif not (uses_content_addressed_assets(config)
+                  and idx.get_asset_hash(index_db(), name)
+                      == file_hash(pdf.expanduser())):
             print('asset directory already contains file: '+str(abs_save_path))
             exit()
-        return pdf_template.format(pdfname=abs_save_path.relative_to(asset_dir))
+        return pdf_template.format(pdfname=name)
     else:
         return ""
 
 
+# the yaml indexes are only used to migrate from older versions
 title_idx_path = make_path_func('title_index')
 tag_idx_path = make_path_func('tag_index')
 group_idx_path = make_path_func('group_index')
 doi_idx_path = make_path_func('doi_index')
+index_db_path = make_path_func('index', '.db')
 doi_cache_path = make_path_func('doi_cache', '.pkl')
 state_path = make_path_func('state')
-load_title_index = t.partial(load, title_idx_path)
-load_tag_index = t.partial(load, tag_idx_path)
-load_group_index = t.partial(load, group_idx_path)
-load_doi_index = t.partial(load, doi_idx_path)
-store_title_index = store(title_idx_path)
-store_tag_index = store(tag_idx_path)
-store_group_index = store(group_idx_path)
-store_doi_index = store(doi_idx_path)
+lock_path = make_path_func('mdn', '.lock')
+
+
+def load_title_index() -> Index:
+    return idx.load_single_index(index_db(), 'title')
+
+
+def load_group_index() -> Index:
+    return idx.load_single_index(index_db(), 'group')
+
+
+def load_doi_index() -> Index:
+    return idx.load_single_index(index_db(), 'doi')
+
+
+def load_tag_index() -> Index:
+    return idx.load_tag_index(index_db())
+
+
+# maps the names of the functions decorated with cached_by_index to the
+# notes_version of the index and their result
+_index_caches: Dict[str, Tuple[Any, Any]] = {}
+
+
+def cached_by_index(f: Callable[[], Any]) -> Callable[[], Any]:
+    '''Decorator for functions that load something from the index. Their
+    result is kept in memory until the notes or tags in the index change,
+    which pays off for long running processes like the daemon or mdn serve.
+    Results are shared, so they must not be modified.
+    Every cache entry is replaced as a whole, so green threads always see
+    a complete one, at worst two of them load the same entry.'''
+    @wraps(f)
+    def wrapper():
+        version = idx.notes_version(index_db())
+        cached = _index_caches.get(f.__name__)
+        if cached is None or cached[0] != version:
+            cached = (version, f())
+            _index_caches[f.__name__] = cached
+        return cached[1]
+    return wrapper
+
+
+@cached_by_index
+def load_notes() -> Dict[int, idx.NoteRecord]:
+    '''Returns the metadata of all notes by id'''
+    return idx.load_notes(index_db())
+
+
+class Listing(NamedTuple):
+    # all notes, the most recently edited first
+    rows: List[Row]
+    tags: Index
+    ids: Set[int]
+
+
+@cached_by_index
+def load_listing() -> Listing:
+    '''Everything query_notes needs, to answer from memory'''
+    conn = index_db()
+    return Listing(list(_rows_by_mtime(conn)), idx.load_tag_index(conn),
+                   idx.note_ids(conn))
+
+
 save_state = store(state_path)
 load_state = t.partial(load, state_path, 
                        lambda: AttrDict(default_state))
@@ -0,0 +1,74 @@
+"""Fetching the bibtex entries of DOIs.
+
+The entries are requested from the DOI resolver via content negotiation,
+several at once, and requests that fail for a reason that might go away
+(timeouts, 429 and 5xx responses) are retried with exponential backoff.
+How a single entry is fetched is up to the transport, a function that maps
+a DOI to its bibtex entry, so the resolver can be replaced, e.g. by a
+local server in tests.
+"""
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+Transport = Callable[[str], str]
+
+default_resolver = 'https://doi.org/'
+bibtex_mime_type = 'application/x-bibtex'
+
+
+def http_transport(base_url: str = default_resolver,
+                   timeout: float = 30) -> Transport:
+    '''Fetches entries from base_url + doi'''
+    import urllib.parse
+    import urllib.request
+
+    def fetch(doi: str) -> str:
+        request = urllib.request.Request(
+            base_url + urllib.parse.quote(doi, safe='/'),
+            headers={'Accept': f'{bibtex_mime_type}; charset=utf-8'})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.read().decode('utf-8')
+    return fetch
+
+
+def is_transient(e: Exception) -> bool:
+    '''Whether the same request might succeed later'''
+    from urllib.error import HTTPError, URLError
+    if isinstance(e, HTTPError):
+        return e.code == 429 or e.code >= 500
+    return isinstance(e, (URLError, TimeoutError, ConnectionError))
+
+
+def fetch_with_retry(transport: Transport, doi: str, retries: int = 3,
+                     backoff: float = 0.5) -> str:
+    for attempt in range(retries + 1):
+        try:
+            return transport(doi)
+        except Exception as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            time.sleep(backoff * 2 ** attempt)
+    assert False
+
+
+def fetch_all(dois: List[str], transport: Optional[Transport] = None,
+              jobs: int = 8, retries: int = 3, backoff: float = 0.5) \
+        -> Tuple[Dict[str, str], Dict[str, Exception]]:
+    '''Fetches the entries of dois, at most jobs at once. Returns the
+    fetched entries and the errors of the DOIs that couldnt be fetched'''
+    fetched: Dict[str, str] = {}
+    failed: Dict[str, Exception] = {}
+    if len(dois) == 0:
+        return fetched, failed
+    from concurrent.futures import ThreadPoolExecutor
+    transport = transport or http_transport()
+    with ThreadPoolExecutor(min(jobs, len(dois))) as pool:
+        futures = {doi: pool.submit(fetch_with_retry, transport, doi,
+                                    retries, backoff)
+                   for doi in dois}
+        for doi, future in futures.items():
+            try:
+                fetched[doi] = future.result()
+            except Exception as e:
+                failed[doi] = e
+    return fetched, failed
@@ -0,0 +1,174 @@
+"""A long running mdn process that answers read only commands.
+
+`mdn daemon` keeps the config and the index in memory and listens on a unix
+socket next to the config file. Commands that are decorated with
+`forwarded` first try to send their arguments to the daemon, which runs the
+command and sends back the output. If no daemon is running, the command
+just runs in the current process.
+
+The request is a single json object. The response is a json object per
+line: chunks of the output as {"stdout": ...} or {"stderr": ...}, sent
+whenever the command flushes or a chunk is full, and finally the exit code
+as {"code": ...}.
+"""
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+from contextlib import redirect_stderr, redirect_stdout
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List
+
+stop_command = '__stop__'
+# output is sent once this many characters were written, or on flush
+chunk_size = 1 << 16
+
+
+def socket_path(config_path: Path) -> Path:
+    return config_path.with_name(config_path.name + '.sock')
+
+
+def connect(path: Path, msg: dict) -> socket.socket:
+    '''Sends msg to the daemon, whose response can then be read from the
+    returned socket with responses'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+        sock.sendall(json.dumps(msg).encode() + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def responses(sock: socket.socket) -> Iterator[dict]:
+    with sock.makefile('rb') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def request(path: Path, msg: dict) -> List[dict]:
+    with connect(path, msg) as sock:
+        return list(responses(sock))
+
+
+def is_running(path: Path) -> bool:
+    try:
+        request(path, {'command': None})
+        return True
+    except OSError:
+        return False
+
+
+def forwarded(get_socket_path: Callable[[], Path]):
+    '''Decorator for click command callbacks. The decorated command is run
+    by the daemon if one is listening on get_socket_path(). The original
+    function is available as __wrapped__'''
+    def decorator(f):
+        @wraps(f)
+        def wrapper(**kwargs):
+            try:
+                sock = connect(get_socket_path(),
+                               {'command': f.__name__, 'params': kwargs})
+            except OSError:
+                return f(**kwargs)
+            code = 0
+            with sock:
+                for response in responses(sock):
+                    for name in ['stdout', 'stderr']:
+                        if name in response:
+                            stream = getattr(sys, name)
+                            stream.write(response[name])
+                            stream.flush()
+                    code = response.get('code', code)
+            if code != 0:
+                sys.exit(code)
+        return wrapper
+    return decorator
+
+
+class _ChunkedOutput(io.TextIOBase):
+    '''Collects the output written to stdout or stderr, and sends it in
+    chunks'''
+    def __init__(self, name: str, send: Callable[[dict], None]):
+        self.name = name
+        self.send = send
+        self.parts: List[str] = []
+        self.size = 0
+
+    def write(self, s: str) -> int:
+        self.parts.append(s)
+        self.size += len(s)
+        if self.size >= chunk_size:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        if self.parts:
+            self.send({self.name: ''.join(self.parts)})
+            self.parts, self.size = [], 0
+
+
+def _run(command: Callable, params: dict, send: Callable[[dict], None]):
+    out, err = _ChunkedOutput('stdout', send), _ChunkedOutput('stderr', send)
+    code = 0
+    with redirect_stdout(out), redirect_stderr(err):
+        try:
+            command(**params)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            print(f'The daemon failed to run the command: {e!r}',
+                  file=sys.stderr)
+            code = 1
+    out.flush()
+    err.flush()
+    send({'code': code})
+
+
+class _Server(socketserver.UnixStreamServer):
+    '''A server that runs until stopped is set by a stop request'''
+    stopped = False
+
+
+def serve(path: Path, commands: Dict[str, Callable]):
+    '''Answers requests on the socket at path until a stop request arrives.
+    commands maps the command names to the functions that run them'''
+    if is_running(path):
+        print(f'A daemon is already listening on {path}', file=sys.stderr)
+        sys.exit(1)
+    if path.exists():
+        path.unlink()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            msg = json.loads(self.rfile.read())
+            command = msg.get('command')
+            if command == stop_command:
+                server.stopped = True
+            elif command in commands:
+                try:
+                    _run(commands[command], msg['params'], self.send)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client stopped reading, e.g. mdn cat | head
+                    pass
+
+        def send(self, response: dict):
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+    old_umask = os.umask(0o077)
+    try:
+        server = _Server(str(path), Handler)
+    finally:
+        os.umask(old_umask)
+    try:
+        with server:
+            while not server.stopped:
+                server.handle_request()
+    finally:
+        path.unlink()
@@ -0,0 +1,141 @@
+"""Exporting notes as a static html site.
+
+The export folder has the same layout as the save path, so the links of the
+rendered notes keep working:
+
+    index.html          links to all groups, tags and notes
+    groups/<group>.html the notes of a group
+    tags/<tag>.html     the notes with a tag
+    html/<id>.html      the notes, copied from the render cache
+    assets/             a copy of the asset folder
+
+Notes are rendered through the render cache of the save path, so only notes
+that changed since the last render or export are rendered again, and only
+files that changed since the last export are copied. Files of notes, groups
+and tags that arent part of the export anymore are removed.
+"""
+import shutil
+from html import escape
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple
+from urllib.parse import quote
+
+from . import core as c
+from . import index_store as idx
+from .attrdict import AttrDict
+
+Link = Tuple[str, str]
+
+
+def export_notes(ids: List[int], out: Path, config: AttrDict,
+                 jobs: int = None, force: bool = False) -> int:
+    '''Exports the notes in ids to out, see the module docstring. Returns the
+    number of notes that had to be rendered'''
+    ids = list(map(int, ids))
+    n_rendered = c.render_notes(ids, config, jobs, force)
+    sync_files({f'{id}.html': c.html_path(id, config) for id in ids},
+               out / 'html')
+    sync_tree(Path(config.save_path, 'assets'), out / 'assets')
+
+    all_notes = c.load_notes()
+    notes = sorted((all_notes[id] for id in ids if id in all_notes),
+                   key=lambda note: note.mtime or 0, reverse=True)
+    groups: Dict[str, List[idx.NoteRecord]] = {}
+    tags: Dict[str, List[idx.NoteRecord]] = {}
+    for note in notes:
+        groups.setdefault(str(note.group), []).append(note)
+        for tag in note.tags:
+            tags.setdefault(tag, []).append(note)
+    write_pages('Group', groups, out / 'groups')
+    write_pages('Tag', tags, out / 'tags')
+    c.write_atomically(out / 'index.html', page('Notes', [
+        ('Groups', index_links('groups', groups)),
+        ('Tags', index_links('tags', tags)),
+        ('Notes', note_links(notes, 'html/'))]))
+    return n_rendered
+
+
+def page_name(name: str) -> str:
+    '''The file name of the page of a group or tag'''
+    return quote(name, safe='@') + '.html'
+
+
+def index_links(folder: str, pages: Dict[str, List[idx.NoteRecord]]) \
+        -> List[Link]:
+    return [(f'{folder}/{quote(page_name(name))}',
+             f'{name} ({len(notes)})') for name, notes in sorted(pages.items())]
+
+
+def note_links(notes: Iterable[idx.NoteRecord], prefix: str) -> List[Link]:
+    return [(f'{prefix}{note.id}.html', str(note.title)) for note in notes]
+
+
+def write_pages(kind: str, pages: Dict[str, List[idx.NoteRecord]],
+                folder: Path):
+    folder.mkdir(0o755, True, True)
+    names = set()
+    for name, notes in pages.items():
+        names.add(page_name(name))
+        c.write_atomically(folder / page_name(name), page(
+            f'{kind} {name}', [('Notes', note_links(notes, '../html/'))],
+            '../index.html'))
+    remove_others(folder, names)
+
+
+def page(title: str, sections: List[Tuple[str, List[Link]]],
+         index: str = None) -> str:
+    parts = ['<!DOCTYPE html><html><head><title>', escape(title),
+             '</title><meta charset="utf-8">',
+             f'<style>{c.content_css()}</style></head><body class="body">']
+    if index:
+        parts.append(f'<p><a href="{index}">All notes</a></p>')
+    parts.append(f'<h1>{escape(title)}</h1>')
+    for heading, links in sections:
+        parts.append(f'<h2>{escape(heading)}</h2><ul>')
+        parts.extend(f'<li><a href="{escape(href)}">{escape(text)}</a></li>'
+                     for href, text in links)
+        parts.append('</ul>')
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+def is_copy_fresh(src: Path, dst: Path) -> bool:
+    if not dst.exists():
+        return False
+    src_st, dst_st = src.stat(), dst.stat()
+    return (src_st.st_size == dst_st.st_size
+            and src_st.st_mtime == dst_st.st_mtime)
+
+
+def sync_files(files: Dict[str, Path], folder: Path):
+    '''Copies files into folder, under the names they are mapped to, unless
+    the copy is up to date. Removes all other files of folder'''
+    folder.mkdir(0o755, True, True)
+    for name, src in files.items():
+        if not is_copy_fresh(src, folder / name):
+            shutil.copy2(src, folder / name)
+    remove_others(folder, set(files))
+
+
+def sync_tree(src: Path, dst: Path):
+    '''Makes dst a copy of the folder src, copying only the files that
+    changed'''
+    if not src.exists():
+        return
+    dst.mkdir(0o755, True, True)
+    for child in src.iterdir():
+        if child.is_dir():
+            sync_tree(child, dst / child.name)
+        elif not is_copy_fresh(child, dst / child.name):
+            shutil.copy2(child, dst / child.name)
+    remove_others(dst, {child.name for child in src.iterdir()})
+
+
+def remove_others(folder: Path, names: Set[str]):
+    for path in folder.iterdir():
+        if path.name in names:
+            continue
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
@@ -1,22 +1,36 @@
 import os
 from importlib import resources
 from pathlib import Path
+from typing import Dict, Optional
 
-from flask import Flask, abort, render_template, send_file, Response
-from flask_socketio import SocketIO, emit
+from flask import (Flask, Response, render_template, request,
+                   send_from_directory)
+from flask_socketio import SocketIO, emit, join_room, leave_room
 
 from .. import core as c
 from .. import resources as res_mod
+from .. import watch
+from ..tag_string_parser import ParserError
 
 join = os.path.join
+notes_page_size = 100
+# a year, for assets whose url changes with their content
+immutable_max_age = 365 * 24 * 3600
 
 config = c.load_config()
+c.keep_index_in_memory = True
 asset_dir = Path(config.save_path) / "assets"
 
 app = Flask(__name__)
 app.config['TEMPLATES_AUTO_RELOAD'] = True
 app.config['SECRET_KEY'] = 'secret!'
 socketio = SocketIO(app)
+# maps the session id of every client to the id of the note it displays
+displayed_notes: Dict[str, str] = {}
+# maps the session id of every client to the seq of its newest get_notes
+newest_notes_requests: Dict[str, int] = {}
+# watches the displayed notes, while push_note_updates runs
+note_watcher: Optional[watch.Watcher] = None
 
 @app.route('/')
 def index():
@@ -25,11 +39,20 @@ def index():
 
 @app.route('/assets/<path:file>')
 def assets(file):
-    file = asset_dir.joinpath(file)
-    if file.exists():
-        return send_file(file)
-    else:
-        return abort(404)
+    '''Answers conditional requests (ETag and Last-Modified) with 304 and
+    range requests with the requested part, so embedded pdfs and videos
+    arent downloaded again on every view. Content addressed assets never
+    change, so browsers may keep them. Everything else might be replaced
+    under the same name, and has to be revalidated'''
+    if file.startswith(c.blob_dir_name + '/'):
+        response = send_from_directory(asset_dir, file, conditional=True,
+                                       max_age=immutable_max_age)
+        response.cache_control.immutable = True
+        return response
+    file = c.resolve_assets([file]).get(file, file)
+    response = send_from_directory(asset_dir, file, conditional=True)
+    response.cache_control.no_cache = True
+    return response
 
 
 @app.route('/res/<file>')
@@ -46,25 +69,117 @@ def test_event(*args):
 
 
 @socketio.event
-def get_notes(pattern, group, tags):
-    rows = c.filter_files(pattern, group, tags)
-    emit("notes", [(row.id, row.title) for row in rows])
-
-
-@socketio.event
-def get_note(id):
-    htmlpath = c.html_path(id, config)
-    path = c.md_path(id, config)
-    if (not htmlpath.exists()) or htmlpath.stat().st_mtime < path.stat().st_mtime:
-        htmlpath.write_text(c.make_html(path.read_text()))
-    html = htmlpath.read_text()
+def get_notes(pattern, group, tags, offset=0, seq=0):
+    '''Sends one page of the matching notes. The client asks for the next
+    page, with the offset of the notes it already has, when the user
+    scrolls to the end of the list. seq numbers the requests of a client,
+    the answer to a request is skipped, if a newer one arrived meanwhile'''
+    sid = request.sid
+    newest_notes_requests[sid] = seq
+
+    def superseded():
+        return newest_notes_requests.get(sid) != seq
+
+    # handlers run in green threads, so this gives newer requests of the
+    # same client, that are already waiting, the chance to supersede this one
+    socketio.sleep(0)
+    if superseded():
+        return
+    try:
+        # one more than requested, to know whether there are more
+        matches = c.query_notes(pattern, group, tags, offset,
+                                notes_page_size + 1)
+    except ParserError as e:
+        # usually a tag string that is still being typed
+        emit("notes", {'seq': seq, 'offset': offset, 'notes': [],
+                       'more': False, 'error': str(e)})
+        return
+    rows = []
+    for row in matches:
+        rows.append(row)
+        if len(rows) % 20 == 0:
+            socketio.sleep(0)
+            if superseded():
+                return
+    emit("notes", {'seq': seq, 'offset': offset,
+                   'notes': [(row.id, row.title)
+                             for row in rows[:notes_page_size]],
+                   'more': len(rows) > notes_page_size, 'error': None})
+
+
+def note_body(id: str) -> str:
+    html = c.render_cached(int(id), config).read_text()
     search_str = '<body class="body">'
     start = html.find(search_str)
     assert start != -1
     end = html.find("</body>")
     assert end != -1
-    emit("note", html[start + len(search_str): end])
+    return html[start + len(search_str): end]
+
+
+def note_room(id: str) -> str:
+    return f'note:{id}'
+
+
+@socketio.event
+def get_note(id):
+    old_id = displayed_notes.get(request.sid)
+    if old_id is not None:
+        leave_room(note_room(old_id))
+    displayed_notes[request.sid] = id
+    # before rendering, so that no later save is missed
+    watch_displayed_notes()
+    join_room(note_room(id))
+    emit("note", note_body(id))
+
+
+@socketio.on('disconnect')
+def disconnect(*args):
+    displayed_notes.pop(request.sid, None)
+    newest_notes_requests.pop(request.sid, None)
+    watch_displayed_notes()
+
+
+def watch_displayed_notes():
+    '''Only the displayed notes are watched, so that polling stats a few
+    files instead of the whole folder'''
+    if note_watcher is not None:
+        note_watcher.set_names({f'{id}.md' for id in displayed_notes.values()})
+
+
+def push_note_updates():
+    '''Sends every displayed note that is saved to all clients that display
+    it. Runs as a background task for as long as the server runs'''
+    global note_watcher
+    md_dir = Path(config.save_path) / 'md'
+    with watch.watch(md_dir, set(), debounce=0) as watcher:
+        note_watcher = watcher
+        watch_displayed_notes()
+        # the watchers block the whole process, so they are only asked
+        # whether something changed, and the waiting is left to socketio
+        interval = 0.1 if isinstance(watcher, watch.InotifyWatcher) else 1
+        while True:
+            changes = watcher.wait(0)
+            if not changes.names:
+                socketio.sleep(interval)
+                continue
+            socketio.sleep(0.05)
+            changed = changes.names | watcher.wait(0).names
+            for id in set(displayed_notes.values()):
+                if f'{id}.md' not in changed \
+                        or not c.md_path(id, config).exists():
+                    continue
+                try:
+                    html = note_body(id)
+                except Exception:
+                    # e.g. a half typed front matter, the next save that
+                    # fixes it is pushed again
+                    app.logger.exception(f'Couldnt render note {id}')
+                    continue
+                socketio.emit('note_updated', {'id': id, 'html': html},
+                              to=note_room(id))
 
 
 def run(port):
+    socketio.start_background_task(push_note_updates)
     socketio.run(app, port=port)
@@ -8,9 +8,23 @@
  * (getNote and getNotes) dont have return values. Instead there are listeners
  * defined on the socket, that are executed, when the server sends the
  * requested information. That is what the socket.on listeners are.
+ * Every request for notes is numbered, so that answers to outdated requests
+ * can be ignored, and typing in the search fields only sends a request once
+ * the user paused for searchDelay ms.
+ * Additionally, the server pushes a note_updated message, whenever the
+ * note that is displayed was saved.
  * finally, the last block attaches the js behavior to the html elements.
  * */
 socket =  io()
+var displayedNote = null
+// the list of notes is loaded page by page, while the user scrolls
+var loadedNotes = 0
+var moreNotes = false
+var loadingNotes = false
+// the number of the newest get_notes request
+var notesRequest = 0
+var searchDelay = 150
+var searchTimer = null
 
 function byId(name) {
 	return document.getElementById(name)
@@ -18,11 +32,30 @@ function byId(name) {
 
 function echo(x) {console.log(x)}
 
-function getNotes(pattern, group, tags) {
-	socket.emit("get_notes", pattern, group, tags)
+function requestNotes(offset) {
+	loadingNotes = true
+	notesRequest += 1
+	socket.emit("get_notes", searchPt(), groupPt(), tagPt(), offset,
+	            notesRequest)
+}
+
+function getNotes() {
+	clearTimeout(searchTimer)
+	requestNotes(0)
+}
+
+function getNotesDebounced() {
+	clearTimeout(searchTimer)
+	searchTimer = setTimeout(getNotes, searchDelay)
+}
+
+function getMoreNotes() {
+	if (!moreNotes || loadingNotes) return
+	requestNotes(loadedNotes)
 }
 
 function getNote(id) {
+    displayedNote = id
     socket.emit("get_note", id)
 }
 
@@ -31,11 +64,16 @@ function displayNote(n) {
     main.innerHTML = n
 }
 
-function updateNotesView(notes) {
+function updateNotesView(page) {
 	var view = byId("notes")
-	while(view.options.length > 0) view.remove(0)
+	if (page.offset == 0) {
+		while(view.options.length > 0) view.remove(0)
+	}
+	loadedNotes = page.offset + page.notes.length
+	moreNotes = page.more
+	loadingNotes = false
 
-	for(var [id, title] of notes) {
+	for(var [id, title] of page.notes) {
 		var opt = document.createElement("option")
 		opt.value = id
 		opt.text = title + " (" + id + ")"
@@ -44,17 +82,33 @@ function updateNotesView(notes) {
 }
 
 socket.on('connect', function (event) {
-	getNotes("", "", "")
+	// the search fields are read, so they have to exist
+	if (document.readyState == "loading")
+		document.addEventListener("DOMContentLoaded", getNotes)
+	else
+		getNotes()
 });
 
-socket.on('notes', function (notes){
-	updateNotesView(notes)
+socket.on('notes', function (page){
+	// the answer to an outdated request
+	if (page.seq != notesRequest) return
+	// the reason why the tag string cant be parsed, shown on hover
+	byId("tag_pattern").title = page.error || ""
+	updateNotesView(page)
+	// the first page might not fill the list, so nothing can be scrolled
+	var view = byId("notes")
+	if (view.scrollHeight <= view.clientHeight) getMoreNotes()
 })
 
 socket.on('note', function (note) {
     displayNote(note)
 });
 
+// sent by the server whenever a note is saved, that this client displays
+socket.on('note_updated', function (update) {
+    if (update.id == displayedNote) displayNote(update.html)
+});
+
 function valById(id) {
     return byId(id).value
 }
@@ -76,15 +130,11 @@ document.addEventListener("DOMContentLoaded", function(){
         getNote(this.options[this.selectedIndex].value)
     })
 
-    byId("search_pattern").addEventListener("input", function() {
-        getNotes(this.value, groupPt(), tagPt())
+    byId("notes").addEventListener("scroll", function(){
+        if (this.scrollTop + this.clientHeight >= this.scrollHeight - 50)
+            getMoreNotes()
     })
 
-    byId("group_pattern").addEventListener("input", function() {
-        getNotes(searchPt(), this.value, tagPt())
-    })
-    
-    byId("tag_pattern").addEventListener("input", function() {
-        getNotes(searchPt(), groupPt(), this.value)
-    })
+    for (var name of ["search_pattern", "group_pattern", "tag_pattern"])
+        byId(name).addEventListener("input", getNotesDebounced)
 });
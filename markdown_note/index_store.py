@@ -0,0 +1,458 @@
+"""SQLite backed storage for the note index.
+
+All metadata that mdn keeps about the notes (title, group, doi, tags and the
+mtime/size of the md file at the time it was indexed) lives in a single
+database file, together with a fulltext index of the notes content. The
+functions in here only deal with the database, finding the database and
+parsing notes is the job of core.
+
+A note whose mtime is NULL has not been read from its file yet (e.g. because
+it was imported from an older index format), so it is missing from the
+fulltext index until `mdn regenerate -i` reparses it.
+
+The database is opened in WAL mode, so several mdn processes can read while
+one of them writes. Notes that are being edited are recorded in the journal
+table, together with the pid of the editing process, until the index is
+updated with their new content. Whoever opens the index next can thereby
+reindex notes whose edit was interrupted.
+"""
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Mapping,
+                    NamedTuple, Optional, Set, Tuple)
+
+Index = Dict[str, Set[int]]
+# an index as read from the yaml files of older versions
+YamlIndex = Mapping[str, Iterable[int]]
+
+_schema_v1 = '''
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY,
+    title TEXT,
+    grp TEXT,
+    doi TEXT,
+    mtime REAL,
+    size INTEGER);
+CREATE INDEX IF NOT EXISTS notes_title ON notes(title);
+CREATE INDEX IF NOT EXISTS notes_grp ON notes(grp);
+CREATE INDEX IF NOT EXISTS notes_doi ON notes(doi);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    PRIMARY KEY (tag, id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tags_id ON tags(id);
+'''
+
+
+def _migrate_to_v2(conn: sqlite3.Connection):
+    try:
+        conn.execute('CREATE VIRTUAL TABLE fulltext USING fts5(body)')
+    except sqlite3.OperationalError:
+        # sqlite was built without fts5, searches will scan all files
+        pass
+    conn.execute('UPDATE notes SET mtime = NULL')
+
+
+def _migrate_to_v4(conn: sqlite3.Connection):
+    # the trigram tokenizer allows to search for any substring, not only for
+    # the start of words
+    conn.execute('DROP TABLE IF EXISTS fulltext')
+    try:
+        conn.execute('CREATE VIRTUAL TABLE fulltext '
+                     'USING fts5(body, tokenize="trigram")')
+    except sqlite3.OperationalError:
+        # sqlite is older than 3.34 or was built without fts5, searches
+        # will scan all files
+        pass
+    conn.execute('UPDATE notes SET mtime = NULL')
+
+
+def _migrate_to_v6(conn: sqlite3.Connection):
+    # the manifest of content addressed assets. blob is the path of the
+    # content, relative to the asset folder
+    conn.execute('CREATE TABLE IF NOT EXISTS assets ('
+                 'name TEXT PRIMARY KEY, hash TEXT NOT NULL, blob TEXT NOT NULL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS assets_hash ON assets(hash)')
+
+
+def _migrate_to_v9(conn: sqlite3.Connection):
+    # a counter that is only increased by changes to the notes and tags
+    # tables, see notes_version
+    conn.execute('CREATE TABLE IF NOT EXISTS notes_version ('
+                 'version INTEGER NOT NULL)')
+    conn.execute('INSERT INTO notes_version SELECT 0 '
+                 'WHERE NOT EXISTS (SELECT 1 FROM notes_version)')
+
+
+_migrations: List[Callable[[sqlite3.Connection], Any]] = [
+    lambda conn: conn.executescript(_schema_v1),
+    _migrate_to_v2,
+    lambda conn: conn.execute(
+        'CREATE INDEX IF NOT EXISTS notes_mtime ON notes(mtime)'),
+    _migrate_to_v4,
+    lambda conn: conn.execute(
+        'CREATE TABLE IF NOT EXISTS renders (id INTEGER PRIMARY KEY, key TEXT)'),
+    _migrate_to_v6,
+    lambda conn: conn.execute(
+        'CREATE TABLE IF NOT EXISTS doi_cache ('
+        'doi TEXT PRIMARY KEY, entry TEXT NOT NULL, fetched_at REAL NOT NULL)'),
+    lambda conn: conn.execute(
+        'CREATE TABLE IF NOT EXISTS journal ('
+        'id INTEGER PRIMARY KEY, pid INTEGER NOT NULL)'),
+    _migrate_to_v9,
+]
+schema_version = len(_migrations)
+
+# maps the names used throughout mdn to the columns of the notes table
+_single_index_columns = {'title': 'title', 'group': 'grp', 'doi': 'doi'}
+
+
+class SchemaError(RuntimeError):
+    pass
+
+
+class NoteRecord(NamedTuple):
+    id: int
+    title: str
+    group: str
+    doi: Optional[str]
+    tags: Set[str]
+    mtime: Optional[float]
+    size: Optional[int]
+    # only used for writing, the notes content for the fulltext index
+    body: Optional[str] = None
+
+
+def connect(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(path), timeout=30)
+    conn.execute('PRAGMA journal_mode = WAL')
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version > schema_version:
+        raise SchemaError(f'The index at {path} was created by a newer '
+                          'version of mdn')
+    if version < schema_version:
+        with conn:
+            for migrate in _migrations[version:]:
+                migrate(conn)
+            conn.execute(f'PRAGMA user_version = {schema_version}')
+    return conn
+
+
+def notes_version(conn: sqlite3.Connection) -> int:
+    '''A value that changes whenever the notes or their tags are modified,
+    either through conn or any other connection. Other tables, like the
+    render keys or the journal, dont change it'''
+    return conn.execute('SELECT version FROM notes_version').fetchone()[0]
+
+
+def _bump_notes_version(conn: sqlite3.Connection):
+    conn.execute('UPDATE notes_version SET version = version + 1')
+
+
+def has_fulltext(conn: sqlite3.Connection) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master "
+                        "WHERE name = 'fulltext'").fetchone() is not None
+
+
+def load_single_index(conn: sqlite3.Connection, name: str) -> Index:
+    '''Returns the index for one of title, group or doi, i.e. a dict that maps
+    every value to the set of ids of the notes that have this value'''
+    column = _single_index_columns[name]
+    index: Index = {}
+    for value, id in conn.execute(
+            f'SELECT {column}, id FROM notes WHERE {column} IS NOT NULL'):
+        index.setdefault(value, set()).add(id)
+    return index
+
+
+def load_tag_index(conn: sqlite3.Connection) -> Index:
+    index: Index = {}
+    for tag, id in conn.execute('SELECT tag, id FROM tags'):
+        index.setdefault(tag, set()).add(id)
+    return index
+
+
+def load_tag_postings(conn: sqlite3.Connection,
+                      tags: Iterable[str]) -> Index:
+    '''Like load_tag_index, but only for the given tags'''
+    tags = list(tags)
+    index: Index = {tag: set() for tag in tags}
+    for tag, id in conn.execute(
+            'SELECT tag, id FROM tags WHERE tag IN '
+            f'({", ".join("?" * len(tags))})', tags):
+        index[tag].add(id)
+    return index
+
+
+def _tags_by_id(rows: Iterable[Tuple[str, int]]) -> Dict[int, Set[str]]:
+    tags: Dict[int, Set[str]] = {}
+    for tag, id in rows:
+        tags.setdefault(id, set()).add(tag)
+    return tags
+
+
+def load_notes(conn: sqlite3.Connection) -> Dict[int, NoteRecord]:
+    '''Returns the reverse of the indexes, i.e. a dict that maps every id to
+    the notes metadata'''
+    tags = _tags_by_id(conn.execute('SELECT tag, id FROM tags'))
+    return {id: NoteRecord(id, title, group, doi, tags.get(id, set()),
+                           mtime, size)
+            for id, title, group, doi, mtime, size in conn.execute(
+                'SELECT id, title, grp, doi, mtime, size FROM notes')}
+
+
+def note_ids(conn: sqlite3.Connection) -> Set[int]:
+    return {id for id, in conn.execute('SELECT id FROM notes')}
+
+
+def iter_by_mtime(conn: sqlite3.Connection) \
+        -> Iterator[Tuple[int, str, str, Optional[float]]]:
+    '''Lazily yields id, title, group and mtime of all notes, the most
+    recently modified first, and those without mtime last'''
+    return conn.execute('SELECT id, title, grp, mtime FROM notes '
+                        'ORDER BY mtime DESC')
+
+
+def get_note(conn: sqlite3.Connection, id: int) -> Optional[NoteRecord]:
+    row = conn.execute('SELECT title, grp, doi, mtime, size FROM notes '
+                       'WHERE id = ?', (id,)).fetchone()
+    if row is None:
+        return None
+    title, group, doi, mtime, size = row
+    tags = {tag for tag, in
+            conn.execute('SELECT tag FROM tags WHERE id = ?', (id,))}
+    return NoteRecord(id, title, group, doi, tags, mtime, size)
+
+
+class Batch:
+    '''Collects changes to the index, which are written in a single
+    transaction by the batch context manager'''
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.has_fulltext = has_fulltext(conn)
+        self.changed = False
+
+    def upsert(self, note: NoteRecord):
+        '''Inserts a note, or updates only the fields of it that changed'''
+        conn = self.conn
+        self.changed = True
+        conn.execute('''
+            INSERT INTO notes(id, title, grp, doi, mtime, size)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                title = excluded.title, grp = excluded.grp,
+                doi = excluded.doi, mtime = excluded.mtime,
+                size = excluded.size''',
+            (note.id, note.title, note.group, note.doi, note.mtime,
+             note.size))
+        conn.execute('DELETE FROM journal WHERE id = ?', (note.id,))
+        old_tags = {tag for tag, in conn.execute(
+            'SELECT tag FROM tags WHERE id = ?', (note.id,))}
+        conn.executemany('DELETE FROM tags WHERE tag = ? AND id = ?',
+                         [(tag, note.id) for tag in old_tags - note.tags])
+        conn.executemany('INSERT INTO tags(tag, id) VALUES (?, ?)',
+                         [(tag, note.id) for tag in note.tags - old_tags])
+        if note.body is not None and self.has_fulltext:
+            conn.execute('DELETE FROM fulltext WHERE rowid = ?', (note.id,))
+            conn.execute('INSERT INTO fulltext(rowid, body) VALUES (?, ?)',
+                         (note.id, note.body))
+
+    def remove(self, id: int):
+        self.changed = True
+        self.conn.execute('DELETE FROM notes WHERE id = ?', (id,))
+        self.conn.execute('DELETE FROM tags WHERE id = ?', (id,))
+        self.conn.execute('DELETE FROM journal WHERE id = ?', (id,))
+        if self.has_fulltext:
+            self.conn.execute('DELETE FROM fulltext WHERE rowid = ?', (id,))
+
+    def clear(self):
+        self.changed = True
+        self.conn.execute('DELETE FROM notes')
+        self.conn.execute('DELETE FROM tags')
+        self.conn.execute('DELETE FROM journal')
+        if self.has_fulltext:
+            self.conn.execute('DELETE FROM fulltext')
+
+
+@contextmanager
+def batch(conn: sqlite3.Connection) -> Iterator[Batch]:
+    '''Usage:
+
+        with batch(conn) as b:
+            b.upsert(note)
+            b.remove(other_id)
+
+    All changes are commited together when the block ends, or none if it
+    raises.'''
+    with conn:
+        b = Batch(conn)
+        yield b
+        if b.changed:
+            _bump_notes_version(conn)
+
+
+def upsert_note(conn: sqlite3.Connection, note: NoteRecord):
+    with batch(conn) as b:
+        b.upsert(note)
+
+
+def remove_note(conn: sqlite3.Connection, id: int):
+    with batch(conn) as b:
+        b.remove(id)
+
+
+def update_notes(conn: sqlite3.Connection, notes: Iterable[NoteRecord],
+                 removed_ids: Iterable[int] = ()):
+    '''Upserts notes and removes removed_ids in a single transaction'''
+    with batch(conn) as b:
+        for note in notes:
+            b.upsert(note)
+        for id in removed_ids:
+            b.remove(id)
+
+
+def replace_all(conn: sqlite3.Connection, notes: Iterable[NoteRecord]):
+    '''Drops the complete index and replaces it with notes in a single
+    transaction'''
+    with batch(conn) as b:
+        b.clear()
+        for note in notes:
+            b.upsert(note)
+
+
+def import_indexes(conn: sqlite3.Connection, title_index: YamlIndex,
+                   group_index: YamlIndex, tag_index: YamlIndex,
+                   doi_index: YamlIndex):
+    '''Fills the database from the old per-field yaml indexes. Since those
+    didnt contain the content of the notes, the notes are stored without
+    mtime.'''
+    def invert(index):
+        return {id: key for key, ids in index.items() for id in ids}
+
+    titles = invert(title_index)
+    groups = invert(group_index)
+    dois = invert(doi_index)
+    tags = _tags_by_id((tag, id) for tag, ids in tag_index.items()
+                       for id in ids)
+
+    replace_all(conn, (NoteRecord(id, titles.get(id), groups.get(id),
+                                  dois.get(id), tags.get(id, set()), None,
+                                  None)
+                       for id in titles.keys() | groups.keys()))
+
+
+def get_render_keys(conn: sqlite3.Connection,
+                    ids: Iterable[int]) -> Dict[int, str]:
+    '''Returns the render keys of the html versions of the notes in ids,
+    notes that werent rendered yet are missing'''
+    ids = list(ids)
+    return dict(conn.execute(
+        'SELECT id, key FROM renders WHERE id IN '
+        f'({", ".join("?" * len(ids))})', ids))
+
+
+def set_render_keys(conn: sqlite3.Connection, keys: Dict[int, str]):
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO renders(id, key) '
+                         'VALUES (?, ?)', keys.items())
+
+
+def remove_render_keys(conn: sqlite3.Connection, ids: Iterable[int]):
+    with conn:
+        conn.executemany('DELETE FROM renders WHERE id = ?',
+                         [(id,) for id in ids])
+
+
+def get_asset_blobs(conn: sqlite3.Connection,
+                    names: Iterable[str]) -> Dict[str, str]:
+    '''Maps those of names that are content addressed assets to their blob'''
+    names = list(names)
+    return dict(conn.execute(
+        'SELECT name, blob FROM assets WHERE name IN '
+        f'({", ".join("?" * len(names))})', names))
+
+
+def get_asset_hash(conn: sqlite3.Connection, name: str) -> Optional[str]:
+    row = conn.execute('SELECT hash FROM assets WHERE name = ?',
+                       (name,)).fetchone()
+    return row and row[0]
+
+
+def blob_for_hash(conn: sqlite3.Connection, hash: str) -> Optional[str]:
+    row = conn.execute('SELECT blob FROM assets WHERE hash = ? LIMIT 1',
+                       (hash,)).fetchone()
+    return row and row[0]
+
+
+def set_asset(conn: sqlite3.Connection, name: str, hash: str, blob: str):
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO assets(name, hash, blob) '
+                     'VALUES (?, ?, ?)', (name, hash, blob))
+
+
+def get_doi_entries(conn: sqlite3.Connection, dois: Iterable[str],
+                    min_fetched_at: Optional[float] = None) \
+        -> Dict[str, str]:
+    '''Returns the cached bibtex entries of those of dois, that were fetched
+    at min_fetched_at (a unix timestamp) or later'''
+    dois = list(dois)
+    return dict(conn.execute(
+        'SELECT doi, entry FROM doi_cache WHERE fetched_at >= ? AND doi IN '
+        f'({", ".join("?" * len(dois))})',
+        (min_fetched_at or 0, *dois)))
+
+
+def store_doi_entries(conn: sqlite3.Connection, entries: Dict[str, str],
+                      fetched_at: float):
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO doi_cache(doi, entry, '
+                         'fetched_at) VALUES (?, ?, ?)',
+                         [(doi, entry, fetched_at)
+                          for doi, entry in entries.items()])
+
+
+def journal_edit(conn: sqlite3.Connection, id: int, pid: int):
+    '''Records that the process pid is editing the note id. The entry is
+    removed by the next upsert or removal of the note'''
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO journal(id, pid) VALUES (?, ?)',
+                     (id, pid))
+
+
+def journaled_edits(conn: sqlite3.Connection) -> Dict[int, int]:
+    '''Maps the ids of the notes in the journal to the pid of the process
+    that edits them'''
+    return dict(conn.execute('SELECT id, pid FROM journal'))
+
+
+def invalidate(conn: sqlite3.Connection, id: int):
+    '''Marks a note as not read from its file, and removes it from the
+    journal'''
+    with conn:
+        conn.execute('UPDATE notes SET mtime = NULL WHERE id = ?', (id,))
+        conn.execute('DELETE FROM journal WHERE id = ?', (id,))
+        _bump_notes_version(conn)
+
+
+def file_stats(conn: sqlite3.Connection) \
+        -> Dict[int, Tuple[Optional[float], Optional[int]]]:
+    '''Maps the id of every note to the mtime and size of its file at the
+    time it was indexed'''
+    return {id: (mtime, size) for id, mtime, size in
+            conn.execute('SELECT id, mtime, size FROM notes')}
+
+
+def unindexed_ids(conn: sqlite3.Connection) -> List[int]:
+    '''Ids of the notes that were not read from their file yet'''
+    return [id for id, in
+            conn.execute('SELECT id FROM notes WHERE mtime IS NULL')]
+
+
+def search_fulltext(conn: sqlite3.Connection, query: str) -> List[int]:
+    '''Returns the ids of the notes matching the fts5 query, best matches
+    first. The fulltext index uses trigrams, so a phrase in the query
+    selects all notes that contain it anywhere, ignoring case'''
+    return [id for id, in conn.execute(
+        'SELECT rowid FROM fulltext WHERE fulltext MATCH ? ORDER BY rank',
+        (query,))]
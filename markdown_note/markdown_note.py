@@ -1,16 +1,20 @@
+import inspect
 import re
-import shutil
 import subprocess as sp
+import sys
+import time
 from pathlib import Path
 from typing import List
 
 import click
 import toolz as t
-from tqdm import tqdm
 
 from . import core as c
+from . import daemon as d
 
 lmap = t.compose(list, t.map)
+forwarded = d.forwarded(lambda: d.socket_path(c.config_path))
+forwarded_commands = ['ls', 'lsg', 'lst', 'cat', 'fd']
 
 new_md_template = '''---
 title: None
@@ -59,36 +63,34 @@ def cli(config_file_path: Path):
     
 
 @cli.command()
-def regenerate():
+@click.option('--incremental', '-i', is_flag=True,
+              help="only reparse notes whose mtime or size changed since "
+                   "they were indexed")
+@click.option('--jobs', '-j', default=None, type=int,
+              help="number of processes used for parsing, defaults to the "
+                   "number of cpus")
+def regenerate(incremental: bool, jobs: int):
     '''recreates all index files.
-    This will parse all notes, and might take some time.'''
-    print('Regenerate index, this may take some time...')
-    for pf in [c.title_idx_path, c.tag_idx_path, c.group_idx_path]:
-        c.unlink_if_existing(pf)
-    tag_idx = {}
-    title_idx = {}
-    group_idx = {}
-    doi_idx = {}
-    empty_set = set()
+    This will parse all notes, and might take some time, unless --incremental
+    is used.'''
+    from tqdm import tqdm
     files = list(Path(c.load_config().save_path, 'md').iterdir())
+    c.assert_all_files_valid(files)
+    if incremental:
+        notes = c.load_notes()
+        stale = [f for f in files
+                 if c.is_index_record_stale(f, notes.get(int(f.stem)))]
+        removed_ids = notes.keys() - {int(f.stem) for f in files}
+        print(f'Updating {len(stale)} notes and removing '
+              f'{len(removed_ids)} from the index')
+        records = tqdm(c.parse_files(stale, jobs), total=len(stale))
+        c.idx.update_notes(c.index_db(), records, removed_ids)
+    else:
+        print('Regenerate index, this may take some time...')
+        records = tqdm(c.parse_files(files, jobs), total=len(files))
+        c.idx.replace_all(c.index_db(), records)
 
-    for file in tqdm(files):
-        title, tags, group, doi = c.parse_file(file.read_text()) 
-        id = int(file.stem)
-        title_idx = c.insert_index_entry(title_idx, title, id)
-        tag_idx = c.update_multi_index(tag_idx, tags, empty_set, id)
-        group_idx = c.insert_index_entry(group_idx, group, id)
-        if doi is not None:
-            doi_idx = c.insert_index_entry(doi_idx, doi, id)
-    c.store_group_index(group_idx)
-    c.store_title_index(title_idx)
-    c.store_tag_index(tag_idx)
-    c.store_doi_index(doi_idx)
-
-    t.thread_first(c.load_state(),
-        (t.assoc, 'next_index', 
-                  max(map(int, [f.stem for f in files])) + 1),
-        c.save_state)
+    c.update_state(next_index=max(map(int, [f.stem for f in files])) + 1)
 
 @cli.command()
 @click.option('--template', '-t', default=None, type=Path)
@@ -103,53 +105,57 @@ def new(template: Path, doi: str, pdf: Path, pdf_asset_path: Path,
         reload: bool):
     '''creates a new note'''
     save_path = Path(c.load_config().save_path)
-    state = c.load_state()
     md_folder = save_path / 'md' 
     md_folder.mkdir(0o755, True, True)
-    new_file_path =  md_folder / f'{state.next_index}.md'
-    c.assert_new_file_does_not_exist(new_file_path)
     if doi is not None:
         bibtex = c.load_bibtex_cached(doi, reload)
         title, author, link = c.get_title_author_and_link(bibtex)
-        template = doi_template.format(author, doi, title, link)
+        content = doi_template.format(author, doi, title, link)
     elif template is not None:
-        template = template.read_text()
+        content = template.read_text()
     else:
-        template = new_md_template
-
-    template += c.get_pdf_template(pdf, pdf_asset_path)
-    new_file_path.write_text(template)
-    t.thread_first(state,
-        (t.assoc, 'next_index', state.next_index + 1),
-        (t.assoc, 'last_created', state.next_index),
-        c.save_state)
-    c.store_group_index(c.insert_index_entry(c.load_group_index(), 
-                      'None', state.next_index))
-    c.store_title_index(c.insert_index_entry(c.load_title_index(), 
-                      'None', state.next_index))
+        content = new_md_template
+
+    content += c.get_pdf_template(pdf, pdf_asset_path)
+    with c.locked():
+        state = c.load_state()
+        new_file_path =  md_folder / f'{state.next_index}.md'
+        c.assert_new_file_does_not_exist(new_file_path)
+        new_file_path.write_text(content)
+        t.thread_first(state,
+            (t.assoc, 'next_index', state.next_index + 1),
+            (t.assoc, 'last_created', state.next_index),
+            c.save_state)
+    c.update_index_files_as_necessary('None', set(), 'None', None,
+                                      state.next_index, content)
     sp.run(f'mdn -c {c.config_path} edit', shell=True)
 
 
 @cli.command()
 @click.argument('id', default='_c')
-def edit(id: str):
+@click.option('--timing', is_flag=True,
+              help="print how long it took from saving to the updated html")
+def edit(id: str, timing: bool):
     '''edit a note'''
     state = c.load_state()
     config = c.load_config()
     path, int_id = c.parse_id(id, Path(c.load_config().save_path), state, 
                             c.load_title_index())
-    htmlpath = c.html_path(int_id, config)
-    htmlpath.parent.mkdir(0o755, True, True)
-
     def render_html(content):
-        htmlpath.write_text(c.make_html(content))
+        c.write_html(int_id, content, config)
 
     c.assert_path_exists(path)
-    c.edit_externally(path, config, render_html)
-    c.save_state(t.assoc(state, 'last_edited', int_id))
+    c.begin_edit(int_id)
+    latencies = c.edit_externally(path, config, render_html)
+    if timing and latencies:
+        print(f'{len(latencies)} renders, save to html latency: '
+              f'mean {1000 * sum(latencies) / len(latencies):.1f}ms, '
+              f'max {1000 * max(latencies):.1f}ms')
+    c.update_state(last_edited=int_id)
     content = path.read_text()
     title, tags, group, doi = c.parse_file(content)
-    c.update_index_files_as_necessary(title, tags, group, doi, int_id)
+    c.update_index_files_as_necessary(title, tags, group, doi, int_id,
+                                      content)
     render_html(content) 
 
 
@@ -160,12 +166,10 @@ def show_one(id: str):
     path, int_id = c.parse_id(id, Path(c.load_config().save_path), state, 
                             c.load_title_index())
     
-    htmlpath = c.html_path(int_id, config)
-    if not htmlpath.exists() or htmlpath.stat().st_mtime < path.stat().st_mtime:
-        htmlpath.write_text(c.make_html(path.read_text()))
+    htmlpath = c.render_cached(int_id, config)
     try:
         sp.Popen(config.browser_cmd.format(htmlpath), shell=True)
-        c.save_state(t.assoc(state, 'last_shown', int_id))
+        c.update_state(last_shown=int_id)
     except sp.CalledProcessError as err:
         c.error(f' There was a problem with the browser command: {err}')
 
@@ -184,7 +188,12 @@ def show(ids: List[str]):
 @click.argument('pattern', default='')
 @click.option('--group', '-g', default=None)
 @click.option('--tags', '-t', default=None)
-def ls (pattern: str, group: str, tags: str):
+@click.option('--limit', '-l', default=None, type=int,
+              help="show at most this many notes")
+@click.option('--offset', '-o', default=0, type=int,
+              help="skip this many of the matching notes")
+@forwarded
+def ls (pattern: str, group: str, tags: str, limit: int, offset: int):
     '''Show a list of all existing notes.
     Tags can be filtered according to logical formulas.
     - is not, & is and and | is or. Nested paranthesis are supported.
@@ -192,12 +201,13 @@ def ls (pattern: str, group: str, tags: str):
     the @bar tag.
     
     If pattern is provided the list will be filtered by whether the pattern is
-    contained in the title. Casing is ignored'''
-    rows = c.filter_files(pattern, group, tags)
-    c.print_table(rows)
+    contained in the title. Casing is ignored.
+    The most recently edited notes are listed first.'''
+    c.print_table(c.filter_files(pattern, group, tags, offset, limit))
 
 
 @cli.command()
+@forwarded
 def lsg():
     '''Shows a list of all existing groups'''
     print("\t".join([f"'{x}'" if " " in x else x
@@ -205,6 +215,7 @@ def lsg():
 
 
 @cli.command()
+@forwarded
 def lst():
     '''Shows a list of all existing tags'''
     print("\t".join([f"'{x}'" if " " in x else x
@@ -218,34 +229,73 @@ def lst():
 def rm(pattern: List[str], group: str, tags: str):
     '''Deletes selected files. Takes the same arguments as ls except for when
     the pattern argument is numeric. Then its treated as an id.'''
-    group_index = c.load_group_index()
-    title_index = c.load_title_index()
-    tags_index = c.load_tag_index()
-    doi_index = c.load_doi_index()
+    notes = c.load_notes()
     config = c.load_config()
 
-    ids = c.multipattern_to_ids(pattern, group, tags, config, None, 
-            group_index, title_index, tags_index)
-    rows = [c.id_to_row(int(id), config, group_index, title_index)
-            for id in ids]
+    ids = c.multipattern_to_ids(pattern, group, tags, config)
+    rows = [c.id_to_row(int(id), config, notes) for id in ids]
 
     if len(ids) > 1 and not c.get_user_delete_confirmation(rows):
         return
 
     for id in ids:
-        ftitle, ftags, fgroup, doi = c.parse_file(
-                c.md_path(id, config).read_text())
-        c.delete_md(id, config)
-        htmlp = c.html_path(id, config)
-        if htmlp.exists():
-            htmlp.unlink()
-        c.store_group_index(c.remove_index_entry(group_index, fgroup, id))
-        c.store_title_index(c.remove_index_entry(title_index, ftitle, id))
-        if doi is not None:
-            c.store_doi_index(c.remove_index_entry(doi_index, doi, id))
-        for tag in ftags:
-            tags_index = c.remove_index_entry(tags_index, tag, id)
-        c.store_tag_index(tags_index)
+        c.assert_path_exists(c.md_path(id, config))
+    # files cant be restored by a rollback, so only the notes whose file
+    # really was deleted are removed from the index
+    deleted, failed = [], []
+    for id in ids:
+        try:
+            c.md_path(id, config).unlink()
+            deleted.append(int(id))
+        except OSError as e:
+            print(f"Couldnt delete note {id}: {e}", file=sys.stderr)
+            failed.append(id)
+    with c.index_batch() as batch:
+        for id in deleted:
+            batch.remove(id)
+    c.forget_html(deleted, config)
+    if failed:
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument('new-group')
+@click.argument('pattern', nargs=-1)
+@click.option('--group', '-g', default=None)
+@click.option('--tags', '-t', default=None)
+def mvgroup(new_group: str, pattern: List[str], group: str, tags: str):
+    '''Moves the selected notes into NEW_GROUP. Takes the same arguments as
+    rm.'''
+    notes = c.load_notes()
+    config = c.load_config()
+    ids = c.multipattern_to_ids(pattern, group, tags, config)
+    rows = [c.id_to_row(int(id), config, notes) for id in ids]
+    if len(ids) > 1 and not c.get_user_confirmation("move", rows):
+        return
+
+    failed = c.rewrite_notes(lmap(int, ids),
+                             t.partial(c.set_group, group=new_group), config)
+    print(f"Moved {len(ids) - len(failed)} notes to {new_group}")
+    if failed:
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument('old-tag')
+@click.argument('new-tag')
+def retag(old_tag: str, new_tag: str):
+    '''Renames the tag OLD_TAG to NEW_TAG in all notes. The @ may be
+    omitted.'''
+    old_tag, new_tag = ['@' + tag.lstrip('@') for tag in (old_tag, new_tag)]
+    if c.tag_pattern.fullmatch(new_tag) is None:
+        c.error(f"{new_tag} is not a valid tag")
+    ids = c.load_tag_index().get(old_tag.lower(), set())
+    failed = c.rewrite_notes(list(ids), t.partial(c.rename_tag, old=old_tag,
+                                                  new=new_tag),
+                             c.load_config())
+    print(f"Renamed {old_tag} to {new_tag} in {len(ids) - len(failed)} notes")
+    if failed:
+        sys.exit(1)
 
 
 @cli.command()
@@ -254,9 +304,7 @@ def rm(pattern: List[str], group: str, tags: str):
 def aa(target, save_path):
     '''Add Asset
     Coppies target to asset-folder/save-path'''
-    abs_save_path = Path(c.load_config().save_path, 'assets', save_path)
-    abs_save_path.parent.mkdir(0o755, True, True)
-    shutil.copyfile(target, abs_save_path)
+    c.add_asset(Path(target), save_path, c.load_config())
    
 
 @cli.command()
@@ -264,11 +312,68 @@ def aa(target, save_path):
 @click.option('--group', '-g', default=None)
 @click.option('--tags', '-t', default=None)
 @click.option('--no-header', '-n', is_flag=True)
+@forwarded
 def cat(pattern: str, group: str, tags: str, no_header: bool):
     '''Display the md version of one or more notes note'''
     ids = c.multipattern_to_ids(pattern, group, tags)
+    asset_dir = Path(c.load_config().save_path, 'assets')
     for id in ids:
-        c.cat_one(id, no_header)
+        c.cat_one(id, no_header, asset_dir)
+
+
+@cli.command()
+@click.argument('pattern', nargs=-1)
+@click.option('--group', '-g', default=None)
+@click.option('--tags', '-t', default=None)
+@click.option('--all', '-a', 'all_notes', is_flag=True,
+              help="render every note, ignoring the other arguments")
+@click.option('--force', '-f', is_flag=True,
+              help="also render notes whose html is up to date")
+@click.option('--jobs', '-j', default=None, type=int,
+              help="number of processes used for rendering, defaults to the "
+                   "number of cpus")
+def render(pattern: List[str], group: str, tags: str, all_notes: bool,
+           force: bool, jobs: int):
+    '''Renders the html version of notes, whose html is outdated.
+    Takes the same arguments as cat.'''
+    config = c.load_config()
+    if all_notes:
+        ids = [int(f.stem) for f in Path(config.save_path, 'md').iterdir()]
+    else:
+        ids = lmap(int, c.multipattern_to_ids(pattern, group, tags, config))
+    n_rendered = c.render_notes(ids, config, jobs, force)
+    print(f'Rendered {n_rendered} of {len(ids)} notes')
+
+
+@cli.command()
+@click.argument('out_dir', type=Path)
+@click.argument('pattern', nargs=-1)
+@click.option('--group', '-g', default=None)
+@click.option('--tags', '-t', default=None)
+@click.option('--all', '-a', 'all_notes', is_flag=True,
+              help="export every note, ignoring the other arguments")
+@click.option('--force', '-f', is_flag=True,
+              help="also render notes whose html is up to date")
+@click.option('--jobs', '-j', default=None, type=int,
+              help="number of processes used for rendering, defaults to the "
+                   "number of cpus")
+def export(out_dir: Path, pattern: List[str], group: str, tags: str,
+           all_notes: bool, force: bool, jobs: int):
+    '''Exports notes as a static html site into OUT_DIR, with index pages
+    for all groups and tags. Takes the same arguments as render.'''
+    from . import export as e
+    config = c.load_config()
+    if out_dir.resolve() == Path(config.save_path).expanduser().resolve():
+        c.error("OUT_DIR must not be the save-path")
+    if all_notes:
+        ids = [int(f.stem) for f in Path(config.save_path, 'md').iterdir()]
+    else:
+        ids = lmap(int, c.multipattern_to_ids(pattern, group, tags, config))
+    start = time.monotonic()
+    n_rendered = e.export_notes(ids, out_dir, config, jobs, force)
+    seconds = time.monotonic() - start
+    print(f'Exported {len(ids)} notes, rendered {n_rendered} of them, in '
+          f'{seconds:.1f}s ({len(ids) / max(seconds, 1e-3):.0f} notes/s)')
 
 
 @cli.command()
@@ -286,19 +391,13 @@ def tobib(pattern: str, bib_file: str, group: str, tags: str, reload: bool):
     if bib_path is None:
         c.error("Couldnt open bib-file. Try specifying one with -b")
 
-    doi_index = c.load_doi_index()
-    group_index = c.load_group_index()
-    title_index = c.load_title_index()
-    tags_index = c.load_tag_index()
+    notes = c.load_notes()
     config = c.load_config()
-    ids = c.multipattern_to_ids(pattern, group, tags, config, None, group_index, 
-                                title_index, tags_index)
+    ids = c.multipattern_to_ids(pattern, group, tags, config)
 
-    doi_lookup = {str(id): doi 
-                  for doi, _ids in doi_index.items() for id in _ids}
     removed_ids, remaining_ids = [], []
     for id in ids:
-        if id in doi_lookup:
+        if notes[int(id)].doi is not None:
             remaining_ids.append(id)
         else:
             removed_ids.append(id)
@@ -306,23 +405,26 @@ def tobib(pattern: str, bib_file: str, group: str, tags: str, reload: bool):
     if len(removed_ids) > 0:
         print("Warning: the following notes were part of the query, but dont "
               "contain a doi and were ignored:")
-        removed_rows = [c.id_to_row(int(id), config, group_index, title_index)
+        removed_rows = [c.id_to_row(int(id), config, notes)
                         for id in removed_ids]
         c.print_table(removed_rows)
 
     if len(remaining_ids) == 0:
         c.error("No files with Doi remaining")
 
-    if bib_path.exists():
-        bib = bib_path.read_text()
-    else:
-        bib = ""
+    bib = bib_path.read_text() if bib_path.exists() else ""
+    dois = [notes[int(id)].doi for id in remaining_ids]
+    entries, skipped = c.merge_bib_entries(
+        c.load_bibtex_entries(dois, reload), bib)
 
-    for id in remaining_ids:
-        entry = c.load_bibtex_cached(doi_lookup[id], reload_cache=reload)
-        bib = c.add_to_bib(entry, bib)
+    if len(skipped) > 0:
+        print("The following dois are already in the bib-file and were "
+              "skipped:")
+        print("\n".join(skipped))
 
-    bib_path.write_text(bib)
+    with bib_path.open('a') as f:
+        for entry in entries:
+            f.write("\n\n" + entry)
 
 
 @cli.command()
@@ -338,29 +440,62 @@ def pmd():
 @click.argument("pattern")
 @click.option("--regex", "-r", is_flag=True)
 @click.option("--no-wildcard", "-n", is_flag=True)
-def fd(pattern: str, regex: bool, no_wildcard: bool):
-    """Searches through the content of all Notes. Treats * as wildcard"""
+@click.option("--limit", "-l", default=None, type=int,
+              help="only show the best LIMIT notes")
+@forwarded
+def fd(pattern: str, regex: bool, no_wildcard: bool, limit: int):
+    """Searches through the content of all Notes. Treats * as wildcard.
+
+    Unless --regex is used, the fulltext index is used to find the notes
+    that can match, and the results are ranked by relevance."""
     if regex:
+        query = None
         pattern = re.compile(pattern)
     elif no_wildcard:
+        query = c.fulltext_query([pattern])
         pattern = re.compile(re.escape(pattern), re.IGNORECASE)
     else:
         elems = pattern.split("*")
+        query = c.fulltext_query(elems)
         pattern = ".*".join(re.escape(elem) for elem in elems)
         pattern = re.compile(pattern, re.IGNORECASE)
 
-    config = c.load_config()
-    files = (Path(config.save_path) / "md").iterdir()
-    results = {file.stem: hits for file in files
-            if (hits := c.get_hits(pattern, file.read_text()))}
-    title_lookup = {str(id): title 
-                    for title, ids in c.load_title_index().items() for id in ids}
-    for (id, hits) in results.items():
-        print(f"{id}: {title_lookup[id]}")
+    notes = c.load_notes()
+    for (id, hits) in t.take(limit, c.search_notes(pattern, query)):
+        print(f"{id}: {notes[id].title}")
         for hit in hits:
             print("\t", hit)
 
 
+@cli.command()
+@click.option("--stop", is_flag=True, help="stop the running daemon")
+def daemon(stop: bool):
+    """Starts a daemon that answers ls, lsg, lst, cat and fd.
+
+    While the daemon runs, these commands are executed by it, which saves
+    them the time to load the config and the index. The daemon runs in the
+    foreground until it is stopped via `mdn daemon --stop`."""
+    path = d.socket_path(c.config_path)
+    if stop:
+        try:
+            d.request(path, {'command': d.stop_command})
+        except OSError:
+            c.error('No daemon is running')
+        return
+
+    c.load_config()
+    c.keep_index_in_memory = True
+    c.load_notes()
+    c.load_listing()
+    callbacks = {}
+    for name in forwarded_commands:
+        callback = cli.commands[name].callback
+        assert callback is not None
+        # the original function, without the forwarding to the daemon
+        callbacks[name] = inspect.unwrap(callback)
+    d.serve(path, callbacks)
+
+
 @cli.command()
 @click.option("--port", "-p", default=5000, type=int)
 def serve(port):
@@ -1,19 +1,35 @@
-from typing import Callable, Tuple, Any, Set, List
+from typing import (Tuple, Set, List, Dict, AbstractSet, Iterator, Optional,
+                    Union)
 from dataclasses import dataclass
-from collections import defaultdict
+from functools import lru_cache
 
-And = 0
 and_symbol = '&'
-Or = 1
 or_symbol = '|'
-Not = 2
 not_symbol = '-'
+open_symbol = '('
+close_symbol = ')'
+tag_token = '@'
+end_token = ''
+_operator_symbols = {and_symbol, or_symbol, not_symbol, open_symbol,
+                     close_symbol}
+_tag_end_symbols = _operator_symbols
+_precedence = {or_symbol: 1, and_symbol: 2}
+
+
+# Besides being called with the tags of a single note, every node can
+# select the ids of all matching notes at once, via set operations on
+# postings, i.e. a dict that maps every tag to the set of ids of the notes
+# that contain it, and the universe, i.e. the set of all ids.
+Postings = Dict[str, AbstractSet[int]]
 
 
 class ParserError(RuntimeError):
-    def __init__(self, msg, reason):
+    '''reason is the part of the input starting at the problem, position
+    its index in the input'''
+    def __init__(self, msg, reason, position=None):
         super().__init__(msg + reason)
         self.reason = reason
+        self.position = position
 
 
 @dataclass
@@ -22,10 +38,11 @@ class Tag:
     def __call__(self, tags: Set[str]) -> bool:
         return self.name in tags
 
+    def select(self, postings: Postings, universe: Set[int]) -> Set[int]:
+        return set(postings.get(self.name, ()))
 
-@dataclass
-class Paranthesis:
-    string: str
+    def tag_names(self) -> Set[str]:
+        return {self.name}
 
 
 @dataclass
@@ -34,6 +51,29 @@ class AndNode:
     def __call__(self, tags: Set[str]) -> bool:
         return all(child(tags) for child in self.children)
 
+    def select(self, postings: Postings, universe: Set[int]) -> Set[int]:
+        # negated children are subtracted, instead of intersecting with
+        # their complement, so the universe is only needed if all are negated
+        positive = [child for child in self.children
+                    if type(child) != NotNode]
+        negative = [child.children[0] for child in self.children
+                    if type(child) == NotNode]
+        if positive:
+            selected = [child.select(postings, universe)
+                        for child in positive]
+            selected.sort(key=len)
+            result = selected[0].intersection(*selected[1:])
+        else:
+            result = set(universe)
+        for child in negative:
+            if not result:
+                break
+            result -= child.select(postings, universe)
+        return result
+
+    def tag_names(self) -> Set[str]:
+        return set().union(*(child.tag_names() for child in self.children))
+
 
 @dataclass
 class OrNode:
@@ -41,6 +81,13 @@ class OrNode:
     def __call__(self, tags: Set[str]) -> bool:
         return any(child(tags) for child in self.children)
 
+    def select(self, postings: Postings, universe: Set[int]) -> Set[int]:
+        return set().union(*(child.select(postings, universe)
+                             for child in self.children))
+
+    def tag_names(self) -> Set[str]:
+        return set().union(*(child.tag_names() for child in self.children))
+
 
 @dataclass
 class NotNode:
@@ -49,113 +96,118 @@ class NotNode:
         assert len(self.children) == 1
         return not self.children[0](tags)
 
-
-def _find_matching_closing_paranthesis(s: str, open_pars=0, idx=1):
-    '''Expects that s does not contain the opening paranthesis, for which the
-    corresponding closing one is searched.
-    If the input was 'foo)' the result will be 4'''
-    if s[0] == '(':
-        return _find_matching_closing_paranthesis(
-                s[1:], open_pars + 1, idx + 1)
-    elif s[0] == ')':
-        if open_pars == 0:
-            return idx
+    def select(self, postings: Postings, universe: Set[int]) -> Set[int]:
+        return universe - self.children[0].select(postings, universe)
+
+    def tag_names(self) -> Set[str]:
+        return self.children[0].tag_names()
+
+
+# the node types of a parsed tag expression
+Node = Union[Tag, AndNode, OrNode, NotNode]
+# a node and the operator that created it, see _combine
+Operand = Tuple[Node, Optional[str]]
+
+
+def _tokenize(s: str) -> Iterator[Tuple[str, int, str]]:
+    '''Yields (kind, position, text) for every token in s, followed by an
+    end token. kind is one of the symbols, tag_token or end_token'''
+    i = 0
+    n = len(s)
+    while i < n:
+        char = s[i]
+        if char.isspace():
+            i += 1
+        elif char in _operator_symbols:
+            yield char, i, char
+            i += 1
+        elif char == '@':
+            start = i
+            i += 1
+            while i < n and not (s[i].isspace() or s[i] in _tag_end_symbols):
+                i += 1
+            yield tag_token, start, s[start:i]
         else:
-            return _find_matching_closing_paranthesis(
-                    s[1:], open_pars - 1, idx + 1)
-    else:
-        return _find_matching_closing_paranthesis(
-                s[1:], open_pars, idx + 1)
-
-
-def _digest(s: str) -> Tuple[Any, str]:
-    if s[0] == '(':
-        end = _find_matching_closing_paranthesis(s[1:])
-        return Paranthesis(s[1:end]), s[end + 1:]
-    elif s[0] == '@':
-        word_end_candidates = [end for end in 
-                                (s.find(x) for x in 
-                                    [' ', and_symbol, or_symbol, 
-                                     '(', not_symbol])
-                                if end > 0]
-        if len(word_end_candidates) > 0:
-            end = min(word_end_candidates)
-            return Tag(s[0:end]), s[end:]
+            raise ParserError(f'Unexpected character at position {i}: ',
+                              s[i:], i)
+    yield end_token, n, ''
+
+
+def _combine(op: str, left: Operand, right: Operand) -> Operand:
+    '''Operands are (node, op) pairs, where op is the operator that created
+    the node, so that chains like @a & @b & @c become a single AndNode'''
+    node_type = AndNode if op == and_symbol else OrNode
+    left_node, left_op = left
+    if left_op == op and isinstance(left_node, (AndNode, OrNode)):
+        left_node.children.append(right[0])
+        return left
+    return node_type([left_node, right[0]]), op
+
+
+def _parse(s: str) -> Node:
+    '''Operator precedence parser. It uses explicit stacks instead of
+    recursion, so neither long nor deeply nested expressions are a problem.
+    `-` binds tighter than `&`, which binds tighter than `|`.'''
+    operands: List[Operand] = []
+    # entries are (symbol, position)
+    operators: List[Tuple[str, int]] = []
+
+    def reduce_top():
+        op, _ = operators.pop()
+        right = operands.pop()
+        left = operands.pop()
+        operands.append(_combine(op, left, right))
+
+    def apply_nots():
+        while operators and operators[-1][0] == not_symbol:
+            operators.pop()
+            operands[-1] = NotNode([operands[-1][0]]), None
+
+    expect_operand = True
+    for kind, pos, text in _tokenize(s):
+        if expect_operand:
+            if kind == not_symbol or kind == open_symbol:
+                operators.append((kind, pos))
+            elif kind == tag_token:
+                operands.append((Tag(text), None))
+                apply_nots()
+                expect_operand = False
+            else:
+                raise ParserError(
+                    f"Expected a tag, '-' or '(' at position {pos}: ",
+                    s[pos:] or '<end of input>', pos)
+        elif kind in _precedence:
+            while (operators and operators[-1][0] in _precedence
+                   and _precedence[operators[-1][0]] >= _precedence[kind]):
+                reduce_top()
+            operators.append((kind, pos))
+            expect_operand = True
+        elif kind == close_symbol:
+            while operators and operators[-1][0] != open_symbol:
+                reduce_top()
+            if not operators:
+                raise ParserError(
+                    f"Unmatched ')' at position {pos}: ", s[pos:], pos)
+            operators.pop()
+            node, _ = operands[-1]
+            operands[-1] = node, None
+            apply_nots()
+        elif kind == end_token:
+            while operators and operators[-1][0] != open_symbol:
+                reduce_top()
+            if operators:
+                pos = operators[-1][1]
+                raise ParserError(
+                    f"Unclosed '(' at position {pos}: ", s[pos:], pos)
         else:
-            return Tag(s), ''
-    elif s[0] == and_symbol:
-        return And, s[1:]
-    elif s[0] == or_symbol:
-        return Or, s[1:]
-    elif s[0] == not_symbol:
-        return Not, s[1:]
-    else:
-        raise ParserError('Error parsing tag strin at: ', s)
-
-
-def _get_object_repr(objs: List[Any], s: str) -> List[Any]:
-    '''Converts a string into its object representation, on direct call use an
-    empty list as first arg'''
-    if s == "": 
-        return objs
-    else: 
-        new_obj, remaining_str = _digest(s.strip())
-        return _get_object_repr(objs + [new_obj], remaining_str.strip())
-
-
-def _split_at(objs, split_target, result):
-    '''like str.split for arbitrary object lists'''
-    try:
-        end = next(i for i, obj in enumerate(objs) if obj == split_target)
-        return _split_at(objs[end + 1:], split_target, result + [objs[:end]])
-    except StopIteration:
-        return result + [objs]
-
-
-def transform_and_group(group):
-    '''takes a list of object representations, as returned by _get_object_repr.
-    Expects that all those objects should be concatenated via and, so every
-    second object must be `And` and returns an AndNode, or if the list only has
-    one element, the element.'''
-    if not all(x == And for x in group[1::2]):
-        raise ValueError(
-            'There is an And-group where not every second element is an And')
-    if len(group) > 1:
-        return AndNode(group[::2])
-    else:
-        return group[0]
-
-
-def _bind_nots(objs: List[Any], result = None):
-    '''replaces every [..., Not, X, ...] by NotNode(X)'''
-    if len(objs) == 0:
-        return result
-    if result is None:
-        result = []
-    if objs[0] == Not:
-        if len(objs) < 2:
-            raise ValueError('There is a `-` without following target')
-        return _bind_nots(objs[2:], result + [NotNode([objs[1]])])
-    else:
-        return _bind_nots(objs[1:], result + objs[:1])
-    
-
-
-def _to_tree(objs):
-    and_groups = _split_at(_bind_nots(objs), Or, [])
-    if len(and_groups) == 1:
-        return transform_and_group(and_groups[0])
-    return OrNode([transform_and_group(group) for group in and_groups])
-
-
-def _clean_tree(tree):
-    if type(tree) == Tag:
-        return tree
-    if type(tree) != Paranthesis:
-        # Must be AndNode or OrNode here
-        return type(tree)([_clean_tree(child) for child in tree.children])
-    return create_predicate_from_tag_str(tree.string)
-
-
-def create_predicate_from_tag_str(s: str)-> Callable[[Set[str]], bool]:
-    return _clean_tree(_to_tree(_get_object_repr([], s)))
+            raise ParserError(
+                f"Expected '&', '|' or ')' at position {pos}: ", s[pos:], pos)
+    return operands[0][0]
+
+
+@lru_cache(256)
+def create_predicate_from_tag_str(s: str) -> Node:
+    '''Parses a tag expression like "@foo & -(@bar | @baz)". The result can
+    be called with the tags of a note, or select all matching notes from
+    the tag postings. Results are cached, so they must not be modified.'''
+    return _parse(s)
@@ -0,0 +1,195 @@
+"""Notifications about changed files in a directory.
+
+On Linux the kernels inotify interface is used (through ctypes, so no
+additional dependency is required). Everywhere else, or if inotify can't be
+used, the directory is polled. Both watchers have the same interface:
+
+    with watch(directory) as watcher:
+        changes = watcher.wait(timeout)
+
+wait blocks until a file changed, or the timeout ran out. Editors usually
+cause several events per save, so changes are debounced: once the first
+change is seen, wait keeps collecting until there was no new one for
+`debounce` seconds.
+"""
+import ctypes
+import os
+import select
+import struct
+import sys
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional, Set, Tuple
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_watch_mask = (IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE
+               | IN_DELETE)
+_event_header = struct.Struct('iIII')
+
+
+class Changes(NamedTuple):
+    names: Set[str]
+    # time.monotonic() of the first change, None if nothing changed
+    first_seen: Optional[float]
+
+
+class Watcher(ABC):
+    names: Optional[Set[str]]
+
+    @abstractmethod
+    def wait(self, timeout: float) -> Changes:
+        '''Blocks until a watched file changed, or timeout seconds passed'''
+
+    def set_names(self, names: Optional[Set[str]]):
+        '''Changes the files that are watched, None means all'''
+        self.names = names
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PollingWatcher(Watcher):
+    def __init__(self, directory: Path, names: Set[str] = None,
+                 interval: float = 1):
+        self.directory = directory
+        self.names = names
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self, names: Set[str] = None) -> Dict[str, Tuple[int, int]]:
+        if names is None:
+            names = (self.names if self.names is not None
+                     else os.listdir(self.directory))
+        snapshot = {}
+        for name in names:
+            try:
+                st = os.stat(self.directory / name)
+            except FileNotFoundError:
+                continue
+            snapshot[name] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def set_names(self, names: Optional[Set[str]]):
+        # files that are watched from now on must not show up as changed
+        old_names = self.names
+        self.names = names
+        if names is None or old_names is None:
+            self.snapshot = self._scan()
+        else:
+            self.snapshot = {name: value
+                             for name, value in self.snapshot.items()
+                             if name in names}
+            self.snapshot.update(self._scan(names - old_names))
+
+    def _changed(self) -> Set[str]:
+        old, self.snapshot = self.snapshot, self._scan()
+        return {name for name in old.keys() | self.snapshot.keys()
+                if old.get(name) != self.snapshot.get(name)}
+
+    def wait(self, timeout: float) -> Changes:
+        deadline = time.monotonic() + timeout
+        while True:
+            changed = self._changed()
+            if changed:
+                return Changes(changed, time.monotonic())
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return Changes(set(), None)
+            time.sleep(min(self.interval, remaining))
+
+
+class InotifyWatcher(Watcher):
+    def __init__(self, directory: Path, names: Set[str] = None,
+                 debounce: float = 0.05):
+        self.directory = directory
+        self.names = names
+        self.debounce = debounce
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if _libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                   _watch_mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'Cant watch {directory}')
+
+    def _read(self, timeout: float) -> Set[str]:
+        if not select.select([self.fd], [], [], max(0, timeout))[0]:
+            return set()
+        buf = os.read(self.fd, 64 * 1024)
+        names = set()
+        offset = 0
+        while offset < len(buf):
+            _, mask, _, length = _event_header.unpack_from(buf, offset)
+            offset += _event_header.size
+            name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, so anything might have changed
+                names.update(os.listdir(self.directory))
+            elif name:
+                names.add(name)
+        if self.names is not None:
+            names &= self.names
+        return names
+
+    def wait(self, timeout: float) -> Changes:
+        deadline = time.monotonic() + timeout
+        while True:
+            changed = self._read(deadline - time.monotonic())
+            if changed:
+                break
+            if time.monotonic() >= deadline:
+                return Changes(set(), None)
+        first_seen = time.monotonic()
+        while True:
+            more = self._read(self.debounce)
+            if not more:
+                return Changes(changed, first_seen)
+            changed |= more
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        # the c library is already loaded into the python process
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+_libc = _load_libc()
+
+
+def watch(directory: Path, names: Set[str] = None,
+          poll_interval: float = 1, debounce: float = 0.05) -> Watcher:
+    '''Returns a watcher for the files in directory, or only for the files
+    called like one of names, if given'''
+    if _libc is not None:
+        try:
+            return InotifyWatcher(directory, names, debounce)
+        except OSError:
+            pass
+    return PollingWatcher(directory, names, poll_interval)
@@ -1,8 +1,8 @@
 from distutils.core import setup
 
 packages = ['markdown_note', 'markdown_note.resources', 'markdown_note.flaskr']
-install_requires = ["markdown", "pyyaml", "toolz", "yattag", "click", 
-                    "tqdm", 'tabulate', 'habanero', "bibtexparser",
+install_requires = ["markdown", "pyyaml", "toolz", "click", 
+                    "tqdm", 'tabulate', "bibtexparser",
                     "flask", "eventlet", "flask-socketio"]
 
 setup(name='Markdown Note',
@@ -1,12 +1,30 @@
+import http.server
+import os
+import subprocess
+import sys
+import threading
+import time
+
 import pytest
 
-from markdown_note.core import (insert_index_entry, parse_file,
-                                remove_index_entry, strip_lines,
-                                update_multi_index)
-from markdown_note.tag_string_parser import (ParserError,
+from markdown_note import core, crossref, daemon, index_store, watch
+from markdown_note.attrdict import AttrDict
+from markdown_note.core import (fulltext_query, parse_file, rename_tag,
+                                render_notes, set_group, strip_lines)
+from markdown_note.tag_string_parser import (AndNode, NotNode, OrNode,
+                                             ParserError, Tag,
                                              create_predicate_from_tag_str)
 
 
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    '''An index database in tmp_path, which core uses as its index'''
+    conn = index_store.connect(tmp_path / 'index.db')
+    monkeypatch.setattr(core, 'index_db', lambda: conn)
+    monkeypatch.setattr(core, '_index_caches', {})
+    return conn
+
+
 def test_tag_parsing():
     with pytest.raises(ParserError):
         create_predicate_from_tag_str('invalid')
@@ -22,37 +40,6 @@ def test_tag_parsing():
     assert create_predicate_from_tag_str('-(@c | (@a & @d))')(tags)
 
 
-def test_remove_index():
-    new_ind = remove_index_entry({
-        'foo': {1, 2},
-        'bar': {3, 4}
-    }, 'foo', 1)
-    assert new_ind['foo'] == {2}
-    new_ind = remove_index_entry(
-        new_ind, 'foo', 2)
-    assert 'foo' not in new_ind
-
-
-def test_insert_index_entry():
-    ind = insert_index_entry({}, 'foo', 1)
-    assert ind['foo'] == {1}
-    assert insert_index_entry(ind, 'foo', 2) == {'foo': {1, 2}}
-
-
-def test_update_tags_index():
-    ind = {'foo': {1, 2},
-           'bar': {2, 3, 4},
-           'baz': {3, 4}}
-    old = { 'foo', 'bar' }
-    new = { 'bar', 'baz' }
-    nind = update_multi_index(ind, new, old, 2)
-    assert nind == {
-        'foo': {1},
-        'bar': {2, 3, 4},
-        'baz': {2, 3, 4}
-    }
-
-
 def test_parse_file():
     content = strip_lines('''
         ---
@@ -67,3 +54,428 @@ def test_parse_file():
     assert tags == {'@baz', '@bar'}
     assert group == 'foo'
     assert doi == None
+    # tags are only taken from the body
+    assert parse_file('---\ntitle: On @foo\ngroup: g\n---\n@bar')[1] \
+        == {'@bar'}
+
+
+def test_load_front_matter():
+    import yaml
+    for header in ['title: Note\ngroup: g\ndoi: 10.1/x', 'title: 12',
+                   'title: true\ngroup:', 'title: "a: b" # c',
+                   'title: 2020-01-01', 'title: [a]\n\ngroup: g']:
+        assert core.load_front_matter(header) == yaml.safe_load(header)
+
+
+def test_index_store(tmp_path):
+    conn = index_store.connect(tmp_path / 'index.db')
+    index_store.import_indexes(
+        conn, {'a': {1}, 'b': {2}}, {'g': {1, 2}}, {'@x': {1, 2}},
+        {'10.1/foo': {2}})
+    assert index_store.load_single_index(conn, 'group') == {'g': {1, 2}}
+    assert index_store.load_single_index(conn, 'doi') == {'10.1/foo': {2}}
+
+    index_store.upsert_note(conn, index_store.NoteRecord(
+        1, 'c', 'g', None, {'@y'}, 1.0, 10))
+    assert index_store.load_single_index(conn, 'title') == {'c': {1}, 'b': {2}}
+    assert index_store.load_tag_index(conn) == {'@x': {2}, '@y': {1}}
+
+    notes = index_store.load_notes(conn)
+    assert notes[2] == index_store.get_note(conn, 2)
+    assert (notes[2].title, notes[2].group, notes[2].doi, notes[2].tags) \
+        == ('b', 'g', '10.1/foo', {'@x'})
+    assert index_store.get_note(conn, 3) is None
+
+    index_store.upsert_note(conn, index_store.NoteRecord(
+        3, 'd', 'g', None, set(), 2.0, 10))
+    # note 2 was imported, so its mtime is unknown
+    assert [row[0] for row in index_store.iter_by_mtime(conn)] == [3, 1, 2]
+    assert 'notes_mtime' in conn.execute(
+        'EXPLAIN QUERY PLAN SELECT id FROM notes ORDER BY mtime DESC'
+    ).fetchone()[-1]
+
+    index_store.remove_note(conn, 2)
+    assert index_store.load_tag_index(conn) == {'@y': {1}}
+    assert index_store.load_single_index(conn, 'doi') == {}
+
+
+def test_incremental_regenerate(tmp_path):
+    md_dir = tmp_path / 'md'
+    md_dir.mkdir()
+    # enough notes for the process pool
+    for id in range(core.min_files_for_process_pool + 1):
+        (md_dir / f'{id}.md').write_text(
+            f'---\ntitle: note {id}\ngroup: g\n---\n@tag{id}')
+    rc = tmp_path / 'rc'
+    rc.write_text(f'save_path: {tmp_path}\n')
+
+    def regenerate(*args):
+        return subprocess.run(
+            [sys.executable, '-c',
+             'from markdown_note.markdown_note import cli; cli()',
+             '-c', str(rc), 'regenerate', *args],
+            capture_output=True, text=True, check=True).stdout
+
+    regenerate('-j', '2')
+    (md_dir / '3.md').write_text('---\ntitle: changed\ngroup: g\n---\n@new')
+    (md_dir / '5.md').unlink()
+    assert 'Updating 1 notes and removing 1 from the index' \
+        in regenerate('-i', '-j', '2')
+    notes = index_store.load_notes(index_store.connect(tmp_path / 'index.db'))
+    assert len(notes) == core.min_files_for_process_pool
+    assert 5 not in notes
+    assert (notes[3].title, notes[3].tags) == ('changed', {'@new'})
+    assert 'Updating 0 notes' in regenerate('-i')
+
+
+def test_query_notes_in_memory(tmp_path, monkeypatch, conn):
+    monkeypatch.setattr(core, 'keep_index_in_memory', True)
+    for id in range(3):
+        index_store.upsert_note(conn, index_store.NoteRecord(
+            id, f'note {id}', 'g', None, {f'@t{id % 2}'}, 1.0 + id, 1))
+
+    def query(tags):
+        return [row.id for row in core.query_notes('', '', tags)]
+
+    assert query('') == ['2', '1', '0']
+    assert query('-@t1') == ['2', '0']
+    assert core.load_listing() is core.load_listing()
+    # writes to other tables than the notes and tags keep the cache
+    listing = core.load_listing()
+    index_store.set_render_keys(conn, {0: 'key'})
+    index_store.journal_edit(conn, 1, 1)
+    assert core.load_listing() is listing
+
+    # changes through other connections invalidate the cache as well
+    other = index_store.connect(tmp_path / 'index.db')
+    index_store.remove_note(other, 2)
+    assert query('-@t1') == ['0']
+
+
+def test_fulltext_index(conn):
+    for id, body in enumerate(['foo bar baz', 'foo foo foobar', 'qux']):
+        index_store.upsert_note(conn, index_store.NoteRecord(
+            id, str(id), 'g', None, set(), 1.0, 1, body))
+    def search(elems):
+        return index_store.search_fulltext(conn, fulltext_query(elems))
+
+    assert search(['foo']) == [1, 0]
+    # matches may start in the middle of a word, and casing is ignored
+    assert search(['oba']) == [1]
+    assert set(search(['BAR'])) == {0, 1}
+    assert search(['foo b', 'z']) == [0]
+    assert search(['"q"ux']) == []
+    # too short to be looked up, so all notes have to be scanned
+    assert fulltext_query(['q', 'x']) is None
+
+    index_store.remove_note(conn, 0)
+    assert search(['baz']) == []
+
+
+def test_search_notes_finds_external_changes(tmp_path, monkeypatch, conn):
+    import re
+    config = AttrDict(save_path=str(tmp_path))
+    monkeypatch.setattr(core, 'load_config', lambda: config)
+    (tmp_path / 'md').mkdir()
+    for id in [0, 1]:
+        path = core.md_path(id, config)
+        path.write_text('---\ntitle: T\ngroup: g\n---\nhorse')
+        index_store.upsert_note(conn, core.index_record(path))
+    # changed outside of mdn, and not indexed at all
+    core.md_path(1, config).write_text('---\ntitle: T\ngroup: g\n---\nzebra')
+    core.md_path(2, config).write_text('---\ntitle: T\ngroup: g\n---\nzebra')
+    hits = core.search_notes(re.compile('zebra'), fulltext_query(['zebra']))
+    assert sorted(id for id, _ in hits) == [1, 2]
+
+
+def test_daemon_forwarding(tmp_path, capsys):
+    sock = tmp_path / 'mdn.sock'
+    calls = []
+
+    def greet(name):
+        calls.append(name)
+        print(f'hello {name}')
+
+    forwarded_greet = daemon.forwarded(lambda: sock)(greet)
+    forwarded_greet(name='local')
+    assert capsys.readouterr().out == 'hello local\n'
+
+    def greet_twice():
+        for _ in range(2):
+            print('hello', flush=True)
+
+    server = threading.Thread(target=daemon.serve,
+                              args=(sock, {'greet': greet,
+                                           'greet_twice': greet_twice}))
+    server.start()
+    while not daemon.is_running(sock):
+        time.sleep(0.01)
+    forwarded_greet(name='remote')
+    # output is sent whenever the command flushes
+    assert daemon.request(sock, {'command': 'greet_twice', 'params': {}}) \
+        == [{'stdout': 'hello\n'}, {'stdout': 'hello\n'}, {'code': 0}]
+    daemon.request(sock, {'command': daemon.stop_command})
+    server.join()
+    assert calls == ['local', 'remote']
+    assert capsys.readouterr().out == 'hello remote\n'
+    assert not sock.exists()
+
+
+def test_import_time_budget():
+    """mdn runs for every shell completion, so importing the cli must not
+    pull in the dependencies that are only needed for rendering or
+    bibliography management."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import markdown_note.markdown_note'],
+        capture_output=True, text=True, check=True)
+    cumulative_us = {}
+    for line in result.stderr.splitlines():
+        _, cumulative, name = line.split('|')
+        if cumulative.strip().isnumeric():
+            cumulative_us[name.strip()] = int(cumulative)
+    for heavy in ['markdown', 'bibtexparser', 'urllib.request', 'yattag',
+                  'tabulate', 'tqdm', 'flask']:
+        assert heavy not in cumulative_us
+    assert cumulative_us['markdown_note.markdown_note'] < 400_000
+
+
+def test_crossref_fetch_all():
+    entries = {'/10.1/a': '@article{a,}', '/10.1/flaky': '@article{f,}'}
+    requests = []
+
+    class Resolver(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            if self.path == '/10.1/flaky' and requests.count(self.path) == 1:
+                self.send_error(503)
+            elif self.path in entries:
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(entries[self.path].encode())
+            else:
+                self.send_error(404)
+
+        def log_message(self, *args):
+            pass
+
+    with http.server.ThreadingHTTPServer(('127.0.0.1', 0), Resolver) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        transport = crossref.http_transport(
+            f'http://127.0.0.1:{server.server_address[1]}/')
+        fetched, failed = crossref.fetch_all(
+            ['10.1/a', '10.1/flaky', '10.1/missing'], transport, backoff=0)
+        server.shutdown()
+    assert fetched == {'10.1/a': '@article{a,}', '10.1/flaky': '@article{f,}'}
+    assert list(failed) == ['10.1/missing']
+    # the 503 is retried, the 404 isnt
+    assert sorted(requests) == ['/10.1/a', '/10.1/flaky', '/10.1/flaky',
+                                '/10.1/missing']
+
+
+def test_doi_cache(tmp_path, monkeypatch, conn):
+    import pickle
+    pkl = tmp_path / 'doi_cache.pkl'
+    pkl.write_bytes(pickle.dumps({'10.1/a': '@article{a,}'}))
+    monkeypatch.setattr(core, 'doi_cache_path', lambda: pkl)
+    core.migrate_doi_cache(conn)
+    assert not pkl.exists() and pkl.with_suffix('.pkl.bak').exists()
+    index_store.store_doi_entries(conn, {'10.1/b': '@article{b,}'}, 2000)
+    assert index_store.get_doi_entries(conn, ['10.1/a', '10.1/b', '10.1/c']) \
+        == {'10.1/a': '@article{a,}', '10.1/b': '@article{b,}'}
+    # entries fetched before min_fetched_at are stale
+    assert index_store.get_doi_entries(conn, ['10.1/b'], 3000) == {}
+
+
+def test_merge_bib_entries():
+    bib = '@article{smith,\n doi = {10.1/A}\n}\n\n@book{smith_2,\n}'
+    new, skipped = core.merge_bib_entries({
+        '10.1/a': '@article{other,\n doi = {10.1/a}\n}',
+        '10.1/b': '@article{smith,\n doi = {10.1/b}\n}',
+        '10.1/c': '@article{smith,\n doi = {10.1/c}\n}',
+    }, bib)
+    assert skipped == ['10.1/a']
+    assert new == ['@article{smith_3,\n doi = {10.1/b}\n}',
+                   '@article{smith_4,\n doi = {10.1/c}\n}']
+
+
+def test_replay_journal(tmp_path, monkeypatch, conn):
+    config = AttrDict(save_path=str(tmp_path))
+    monkeypatch.setattr(core, 'load_config', lambda: config)
+    (tmp_path / 'md').mkdir()
+    for id in [0, 1]:
+        path = core.md_path(id, config)
+        path.write_text('---\ntitle: Old\ngroup: g\n---\n')
+        index_store.upsert_note(conn, core.index_record(path))
+    # an editor that ended without updating the index, and one that still runs
+    dead = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                          capture_output=True, text=True).stdout
+    index_store.journal_edit(conn, 0, int(dead))
+    index_store.journal_edit(conn, 1, os.getpid())
+    for id in [0, 1]:
+        core.md_path(id, config).write_text('---\ntitle: New\ngroup: g\n---\n')
+    core.replay_journal(conn)
+    assert index_store.load_single_index(conn, 'title') == {'New': {0},
+                                                            'Old': {1}}
+    assert index_store.journaled_edits(conn) == {1: os.getpid()}
+
+
+def test_render_cache(tmp_path, conn):
+    config = AttrDict(save_path=str(tmp_path))
+    md = tmp_path / 'md' / '0.md'
+    md.parent.mkdir()
+    md.write_text('---\ntitle: T\ngroup: g\n---\n# Hello')
+    assert render_notes([0], config) == 1
+    assert '<h1 id="hello">Hello</h1>' in (tmp_path / 'html/0.html').read_text()
+    assert render_notes([0], config) == 0
+    assert render_notes([0], config, force=True) == 1
+
+    md.write_text('---\ntitle: T\ngroup: g\n---\n# World')
+    assert render_notes([0], config) == 1
+    (tmp_path / 'html/0.html').unlink()
+    assert render_notes([0], config) == 1
+    assert index_store.get_render_keys(conn, [0, 1]).keys() == {0}
+    core.forget_html([0], config)
+    assert index_store.get_render_keys(conn, [0]) == {}
+    assert render_notes([0], config) == 1
+
+
+def test_export(tmp_path, conn):
+    from markdown_note import export
+    config = AttrDict(save_path=str(tmp_path / 'notes'))
+    (tmp_path / 'notes/md').mkdir(parents=True)
+    (tmp_path / 'notes/assets').mkdir()
+    (tmp_path / 'notes/assets/a.png').write_bytes(b'png')
+    for id, group in [(0, 'a/b'), (1, 'c')]:
+        path = core.md_path(id, config)
+        path.write_text(f'---\ntitle: <{id}>\ngroup: {group}\n---\n@t ![](a.png)')
+        index_store.upsert_note(conn, core.index_record(path))
+    out = tmp_path / 'out'
+    assert export.export_notes([0, 1], out, config) == 2
+    assert (out / 'assets/a.png').read_bytes() == b'png'
+    assert '<a href="../html/1.html">&lt;1&gt;</a>' \
+        in (out / 'tags/@t.html').read_text()
+    assert 'href="groups/a%252Fb.html"' in (out / 'index.html').read_text()
+    assert (out / 'groups/a%2Fb.html').exists()
+    # only what changed is rendered, and removed notes disappear
+    assert export.export_notes([1], out, config) == 0
+    assert sorted(p.name for p in (out / 'html').iterdir()) == ['1.html']
+    assert sorted(p.name for p in (out / 'groups').iterdir()) == ['c.html']
+
+
+def test_content_addressed_assets(tmp_path, conn):
+    config = AttrDict(save_path=str(tmp_path), content_addressed_assets=True)
+    pdf = tmp_path / 'paper.pdf'
+    pdf.write_bytes(b'%PDF' * 100000)
+    core.add_asset(pdf, 'a.pdf', config)
+    core.add_asset(pdf, 'sub/b.pdf', config)
+    blobs = list((tmp_path / 'assets' / core.blob_dir_name).iterdir())
+    assert len(blobs) == 1 and blobs[0].read_bytes() == pdf.read_bytes()
+
+    md = '---\ntitle: T\ngroup: g\n---\n![a](a.pdf) and [b](sub/b.pdf) [c](c)'
+    assets = core.note_assets(md)
+    blob = f'{core.blob_dir_name}/{blobs[0].name}'
+    assert assets == {'a.pdf': blob, 'sub/b.pdf': blob}
+    assert core.rewrite_link_targets(md, assets).endswith(
+        f'![a]({blob}) and [b]({blob}) [c](c)')
+
+
+@pytest.mark.parametrize('make_watcher', [
+    watch.watch, lambda d, names: watch.PollingWatcher(d, names, 0.01)])
+def test_watch(tmp_path, make_watcher):
+    note = tmp_path / '1.md'
+    note.write_text('a')
+    with make_watcher(tmp_path, {'1.md'}) as watcher:
+        assert watcher.wait(0.05).names == set()
+
+        def save():
+            time.sleep(0.05)
+            (tmp_path / 'other.md').write_text('b')
+            (tmp_path / '1.md.tmp').write_text('bb')
+            (tmp_path / '1.md.tmp').rename(note)
+
+        threading.Thread(target=save).start()
+        changes = watcher.wait(2)
+        assert changes.names == {'1.md'}
+        assert changes.first_seen is not None
+
+        note.write_text('ccc')
+        time.sleep(0.05)
+        assert watcher.wait(0).names == {'1.md'}
+
+        # newly watched files dont count as changed
+        watcher.set_names({'1.md', 'other.md'})
+        assert watcher.wait(0).names == set()
+        (tmp_path / 'other.md').write_text('dddd')
+        time.sleep(0.05)
+        assert watcher.wait(0).names == {'other.md'}
+
+
+def test_index_batch(tmp_path):
+    conn = index_store.connect(tmp_path / 'index.db')
+    with index_store.batch(conn) as b:
+        for id in range(3):
+            b.upsert(index_store.NoteRecord(id, 't', 'g', None, {'@a'}, 1, 1))
+        b.remove(1)
+    assert index_store.load_tag_index(conn) == {'@a': {0, 2}}
+
+    with pytest.raises(KeyError):
+        with index_store.batch(conn) as b:
+            b.remove(0)
+            raise KeyError()
+    assert index_store.load_tag_index(conn) == {'@a': {0, 2}}
+
+
+def test_bulk_edits():
+    content = '---\ntitle: T\ngroup: old\n---\n@foo @foobar x@foo (@Foo)\n'
+    assert set_group(content, 'new') == content.replace('old', 'new')
+    assert set_group('---\ntitle: T\n---\nx', 'a: b') \
+        == "---\ntitle: T\ngroup: 'a: b'\n---\nx"
+    assert rename_tag(content, '@foo', '@bar') \
+        == content.replace('@foo @', '@bar @').replace('@Foo', '@bar')
+    with pytest.raises(core.NoteFormatError):
+        set_group('no front matter', 'new')
+
+
+def test_rewrite_notes_validates_first(tmp_path, conn):
+    config = AttrDict(save_path=str(tmp_path))
+    (tmp_path / 'md').mkdir()
+    good = '---\ntitle: T\ngroup: old\n---\n'
+    bad = '---\ntitle: [half typed\ngroup: old\n---\n'
+    core.md_path(0, config).write_text(good)
+    core.md_path(1, config).write_text(bad)
+    with pytest.raises(SystemExit):
+        core.rewrite_notes([0, 1], lambda c: set_group(c, 'new'), config)
+    assert core.md_path(0, config).read_text() == good
+    assert core.rewrite_notes([0], lambda c: set_group(c, 'new'), config) == []
+    assert index_store.load_single_index(conn, 'group') == {'new': {0}}
+
+
+def test_tag_selection():
+    postings = {'@a': {1, 2}, '@b': {2, 3}, '@foo': {1, 3, 4}}
+    universe = {1, 2, 3, 4, 5}
+    for query in ['@a', '@foo | @bar', '@foo & @bar', '(@foo & @b) | @a',
+                  '-@a', '-(@a | @bar)', '-@a & -@b', '@foo & -@a & -@bar',
+                  '-(@b | (@a & @foo))']:
+        predicate = create_predicate_from_tag_str(query)
+        expected = {id for id in universe
+                    if predicate({tag for tag, ids in postings.items()
+                                  if id in ids})}
+        assert predicate.select(postings, universe) == expected, query
+    assert create_predicate_from_tag_str('@a & -(@b | @c)').tag_names() \
+        == {'@a', '@b', '@c'}
+
+
+def test_tag_parser():
+    parse = create_predicate_from_tag_str
+    assert parse('@a & @b & @c') == AndNode([Tag('@a'), Tag('@b'), Tag('@c')])
+    assert parse('@a | -@b & @c') == OrNode(
+        [Tag('@a'), AndNode([NotNode([Tag('@b')]), Tag('@c')])])
+    assert parse('(' * 5000 + '@a' + ')' * 5000) == Tag('@a')
+    assert len(parse(' | '.join(f'@t{i}' for i in range(5000))).children) \
+        == 5000
+    for query, position in [('@a @b', 3), ('@a & (@b', 5), ('@a)', 2),
+                            ('@a &', 4), ('@a & x', 5)]:
+        with pytest.raises(ParserError) as e:
+            parse(query)
+        assert e.value.position == position, query